@@ -0,0 +1,92 @@
+"""Per-field fingerprints of indexed documents, to re-enrich and re-upload only what changed.
+
+A record's fingerprints hash its own fields (image URL, caption) and, for
+each derived field, the image together with the model, prompt and settings
+versions that produced it. Comparing them with the fingerprints of the last
+upload tells which fields are stale.
+"""
+import logging
+from typing import Dict, List, Optional
+
+from enrichmentCache import content_hash, version_of
+from multiModelsEmbedding import vectorize_cache_version
+from multiModelsPictureProcess import content_cache_version
+from objectDefinition import ImageData, TextData
+from ocrStrategy import ocr_layout_min_lines, ocr_layout_min_table_rows, ocr_min_read_confidence, ocr_strategy
+from pictureFormatProcess import image_normalize_enabled, image_normalize_version, image_targets
+from pictureOcrProcess import image_analysis_cache_version, layout_cache_version
+from textEmbeddingProcess import embedding_cache_version
+from textPreparation import (
+    embedding_max_tokens,
+    ocr_chunk_overlap_tokens,
+    ocr_chunk_tokens,
+    ocr_chunking_enabled,
+)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# fields copied from the record rather than derived from the image
+record_fields = ("imageUrl", "caption")
+# kept with the fingerprints rather than compared: how many OCR chunk documents were uploaded
+chunk_count_key = "ocrChunkCount"
+
+
+def _image_version(service: str) -> str:
+    # the copy of the image a service sees depends on its normalization target
+    return version_of(image_normalize_version, repr(image_targets.get(service))) if image_normalize_enabled else "original"
+
+
+def _derived_field_versions() -> Dict[str, str]:
+    image_analysis = version_of(image_analysis_cache_version, _image_version("imageAnalysis"))
+    content = version_of(content_cache_version, _image_version("gpt4o"))
+    ocr_content = version_of(image_analysis, layout_cache_version, _image_version("documentIntelligence"),
+                             ocr_strategy, str(ocr_layout_min_lines), str(ocr_layout_min_table_rows),
+                             str(ocr_min_read_confidence))
+    return {
+        "content": content,
+        "ocrContent": ocr_content,
+        "imageVector": version_of(vectorize_cache_version, _image_version("vectorize")),
+        "captionVector": version_of(image_analysis, embedding_cache_version),
+        "contentVector": version_of(content, embedding_cache_version),
+        "ocrContentVector": version_of(ocr_content, image_analysis, embedding_cache_version, str(embedding_max_tokens)),
+        "ocrChunks": version_of(ocr_content, embedding_cache_version, str(ocr_chunking_enabled),
+                                str(ocr_chunk_tokens), str(ocr_chunk_overlap_tokens)),
+    }
+
+
+# what each derived field was computed with, keyed like the enrichment results
+derived_field_versions = _derived_field_versions()
+
+
+def image_identity(image_bytes: Optional[bytes], image_url: str) -> str:
+    """Hash of the image bytes, or of the URL when the services fetch the image themselves."""
+    return content_hash(image_bytes) if image_bytes is not None else "url:" + content_hash(image_url)
+
+
+def record_fingerprints(item: ImageData, identity: str) -> Dict[str, str]:
+    fingerprints = {"imageUrl": content_hash(item.imageUrl), "caption": content_hash(item.caption)}
+    for name, version in derived_field_versions.items():
+        fingerprints[name] = version_of(identity, version)
+    return fingerprints
+
+
+def text_record_fingerprints(item: TextData, vectorize_text: str) -> Dict[str, str]:
+    return {"caption": content_hash(item.title),
+            "content": content_hash(item.content),
+            "captionVector": version_of(content_hash(item.title), embedding_cache_version),
+            "contentVector": version_of(content_hash(item.content), embedding_cache_version, str(embedding_max_tokens)),
+            "imageVector": version_of(content_hash(vectorize_text), vectorize_cache_version)}
+
+
+def uploaded_chunk_count(fingerprints: Optional[Dict[str, str]]) -> Optional[int]:
+    """Number of OCR chunk documents of the last upload; None when it was not recorded."""
+    if fingerprints is None or chunk_count_key not in fingerprints:
+        return None
+    return int(fingerprints[chunk_count_key])
+
+
+def stale_fields(previous: Optional[Dict[str, str]], current: Dict[str, str]) -> List[str]:
+    """Fields whose fingerprint changed since the last upload; every field when there is none."""
+    if previous is None:
+        return list(current)
+    return [name for name, fingerprint in current.items() if previous.get(name) != fingerprint]
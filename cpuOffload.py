@@ -0,0 +1,76 @@
+"""Runs CPU-bound image work (decode, resize, encode) off the event loop.
+
+``CPU_POOL_KIND`` selects a ``process`` pool (default, uses every core), a
+``thread`` pool (Pillow releases the GIL for most codecs) or ``inline`` to
+run on the loop as before. Functions and arguments sent to a process pool
+must be picklable, so offloaded functions live at module level.
+"""
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+R = TypeVar("R")
+
+cpu_pool_kind = os.getenv("CPU_POOL_KIND", "process")
+cpu_pool_workers = int(os.getenv("CPU_POOL_WORKERS", "0")) or os.cpu_count() or 1
+# below this many bytes the hand-off costs more than the work itself
+cpu_offload_min_bytes = int(os.getenv("CPU_OFFLOAD_MIN_BYTES", str(64 * 1024)))
+
+_executor: Optional[Executor] = None
+
+
+def get_cpu_executor() -> Optional[Executor]:
+    global _executor
+    if cpu_pool_kind == "inline":
+        return None
+    if _executor is None:
+        logging.info(f"Starting {cpu_pool_kind} pool with {cpu_pool_workers} workers for image work")
+        if cpu_pool_kind == "process":
+            _executor = ProcessPoolExecutor(max_workers=cpu_pool_workers)
+        elif cpu_pool_kind == "thread":
+            _executor = ThreadPoolExecutor(max_workers=cpu_pool_workers, thread_name_prefix="cpu")
+        else:
+            raise ValueError(f"Unknown CPU_POOL_KIND: {cpu_pool_kind}")
+    return _executor
+
+
+async def run_cpu_bound(func: Callable[..., R], *args: Any, size: Optional[int] = None) -> R:
+    """Run ``func(*args)`` in the CPU pool and await its result.
+
+    ``size`` is the payload size in bytes; small payloads run inline.
+    """
+    executor = get_cpu_executor()
+    if executor is None or (size is not None and size < cpu_offload_min_bytes):
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+
+def shutdown_cpu_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+if __name__ == "__main__":
+    # 示例调用
+    import base64
+
+    async def _main():
+        payload = os.urandom(4 * 1024 * 1024)
+        encoded = await run_cpu_bound(base64.b64encode, payload, size=len(payload))
+        print(len(encoded))
+
+    try:
+        asyncio.run(_main())
+    finally:
+        shutdown_cpu_executor()
@@ -1,109 +1,472 @@
 """Data utilities for index preparation."""
 import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-from multiModelsEmbedding import get_picture_embedding
-from multiModelsPictureProcess import get_content_by_mulit_model
-from objectDefinition import Document, ImageData, RecordResult
-from pictureFormatProcess import download_and_save_as_pdf
-from pictureOcrProcess import analyze_document, get_image_caption_byCV
-from textEmbeddingProcess import get_text_embedding
+from changeDetection import (
+    chunk_count_key,
+    image_identity,
+    record_fields,
+    record_fingerprints,
+    stale_fields,
+    text_record_fingerprints,
+    uploaded_chunk_count,
+)
+from enrichmentCache import content_hash
+from imageDedup import ImageDeduplicator, image_dedup_enabled
+from ingestionEngine import ServiceSlots, bounded_map, default_max_in_flight, percentile
+from ingestionJournal import IngestionJournal
+from localImages import is_local_image_source, iter_local_images, read_local_image
+from multiModelsEmbedding import (
+    get_picture_embedding,
+    get_picture_embedding_from_bytes,
+    get_text_embedding_by_computer_vision,
+)
+from multiModelsPictureProcess import (
+    get_content_by_mulit_model,
+    get_content_by_mulit_model_from_bytes,
+)
+from objectDefinition import Document, ImageData, LocalImageData, RecordResult, TextData, document_fields
+from ocrStrategy import get_ocr_content
+from pictureFormatProcess import (
+    download_image_bytes,
+    log_normalization_savings,
+    normalize_image_for_services,
+)
+from pictureOcrProcess import analyze_image_byCV, analyze_image_byCV_from_bytes
+from recordSources import RecordSource
+from serviceClients import close_clients
+from stagingStore import StagingWriter
+from stageGraph import Stage, StageFailedError, run_stage_graph, select_stages
+from textEmbeddingProcess import get_text_embedding_batched
+from textPreparation import fit_with_suffix, ocr_chunking_enabled, split_into_chunks
 
-pdf_dir = "docs/pdf"
+# download each image once and send the bytes to every analyzer
+default_download_once = os.getenv("INGEST_DOWNLOAD_ONCE", "true").lower() == "true"
+# text sent to Computer Vision vectorizeText for posts without an image, which takes short texts only
+cv_text_max_chars = int(os.getenv("CV_TEXT_MAX_CHARS", "100"))
 
-async def process_images_records(file_path: str)->RecordResult:
-    
-    documents = []
-    errorRecords = []
-    image_data_list = []
-
-    try:
-        # Read the file
-        with open(file_path, 'r', encoding='utf-8') as file:
-            for line in file:
-                try:
-                    # Manually parse the line to extract fields
-                    line = line.strip()
-                    id_start = line.find("'id': '") + len("'id': '")
-                    id_end = line.find("',", id_start)
-                    image_id = line[id_start:id_end]
-
-                    image_url_start = line.find("'imageUrl': '") + len("'imageUrl': '")
-                    image_url_end = line.find("',", image_url_start)
-                    image_url = line[image_url_start:image_url_end]
-
-                    caption_start = line.find("'caption': '") + len("'caption': '")
-                    caption_end = line.rfind("'}")
-                    caption = line[caption_start:caption_end]
-
-                    # Escape special characters
-                    image_id = image_id.replace("'", "\\'")
-                    image_url = image_url.replace("'", "\\'")
-                    caption = caption.replace("'", "\\'")
-
-                    # Create an ImageData object
-                    image_data = ImageData(id=image_id, imageUrl=image_url, caption=caption)
-                    # Add the object to the list
-                    image_data_list.append(image_data)
-                except Exception as e:
-                    print(f"Error processing line: {line}")
-                    print(f"Error message: {e}")
-    except Exception as e:
-        print(f"Error processing file: {file_path}")
-        raise e
+# enrichment results that make up a document, shared between near-duplicate images
+_enrichment_fields = ("content", "ocrContent", "captionVector", "contentVector", "ocrContentVector", "imageVector",
+                      "ocrChunks")
+# enrichment results stored under a different document field name
+_document_field_names = {"ocrContentVector": "ocrContentVecotor", "imageVector": "imageVecotor"}
+
+async def process_images_records(file_path: str,
+                                 max_in_flight: int = default_max_in_flight,
+                                 service_limits: Optional[Dict[str, int]] = None,
+                                 ordered: bool = True,
+                                 download_once: bool = default_download_once,
+                                 journal: Optional[IngestionJournal] = None,
+                                 resume: bool = False,
+                                 staging: Optional[StagingWriter] = None,
+                                 incremental: bool = False)->RecordResult:
     
-    recordResult = RecordResult(documentList=documents, failedImageList=errorRecords, totalRecords=len(image_data_list))
+    recordResult = RecordResult(documentList=[], failedImageList=[], totalRecords=0)
+
+    async for document in stream_images_records(file_path, recordResult,
+                                                max_in_flight=max_in_flight,
+                                                service_limits=service_limits,
+                                                ordered=ordered,
+                                                download_once=download_once,
+                                                journal=journal,
+                                                resume=resume,
+                                                staging=staging,
+                                                incremental=incremental):
+        recordResult.documentList.append(document)
+
+    return recordResult
+
+async def stream_images_records(file_path: str,
+                                recordResult: RecordResult,
+                                max_in_flight: int = default_max_in_flight,
+                                service_limits: Optional[Dict[str, int]] = None,
+                                ordered: bool = True,
+                                download_once: bool = default_download_once,
+                                journal: Optional[IngestionJournal] = None,
+                                resume: bool = False,
+                                staging: Optional[StagingWriter] = None,
+                                incremental: bool = False) -> AsyncIterator[Document]:
+    """Yield enriched documents as they complete, reading records lazily.
+
+    Image records go through the vision stages; text-only records (posts
+    without an image) only get text embeddings. When ``file_path`` is a
+    directory or glob of local images instead of a record file, each file is
+    read in the read pool and its bytes are analyzed directly.
+
+    Only ``max_in_flight`` records (plus the reorder buffer) are held at a
+    time; ``recordResult`` collects the record count, the failed records and
+    the malformed lines, its ``documentList`` is left untouched. With a
+    ``journal`` every finished stage and failure is checkpointed, and
+    ``resume`` skips the records the journal already marks as uploaded. Documents are also written to
+    ``staging`` when given, so they can be indexed again without enrichment.
+
+    The journal also keeps the field fingerprints of every upload. With
+    ``incremental`` a record that did not change since its last upload yields
+    nothing, and one that changed yields a partial document with only the
+    stale fields, recomputed. Partial documents, the chunk documents rebuilt
+    with them and chunk deletions are not staged.
+    """
+
+    def counted_records() -> Iterator[Union[ImageData, TextData, LocalImageData]]:
+        skipped = 0
+        source = RecordSource(file_path)
+        records = iter_local_images(file_path) if is_local_image_source(file_path) else iter_records(file_path, source)
+        for item in records:
+            recordResult.totalRecords += 1
+            # local files are only known by id once read, see worker
+            if resume and journal is not None and item.id is not None and journal.is_uploaded(item.id):
+                skipped += 1
+                continue
+            yield item
+        recordResult.malformedLines.extend(source.malformed)
+        if skipped:
+            logging.info(f"Resuming: skipped {skipped} records already uploaded")
+
+    slots = ServiceSlots(service_limits)
+    # near-duplicates are detected on the downloaded bytes
+    deduplicator = ImageDeduplicator() if download_once and image_dedup_enabled else None
+    latencies = []
+
+    def process(record: Union[ImageData, TextData], image_bytes: Optional[bytes], **kwargs):
+        if isinstance(record, TextData):
+            return process_text_record(record, slots, **kwargs)
+        return process_image_record(record, slots, download_once, deduplicator=deduplicator,
+                                    image_bytes=image_bytes, **kwargs)
+
+    async def worker(item: Union[ImageData, TextData, LocalImageData]) -> List[Document]:
+        started = time.monotonic()
+        record, image_bytes = item, None
+        if isinstance(item, LocalImageData):
+            try:
+                image_bytes = await read_local_image(item)
+            except Exception as e:
+                raise StageFailedError("imageBytes", e)
+            if resume and journal is not None and journal.is_uploaded(item.id):
+                return []
+            record = ImageData(id=item.id, imageUrl=item.path, caption=item.caption)
+
+        if journal is None:
+            documents = await process(record, image_bytes)
+        else:
+            journal.mark_started(record)
+            documents = await process(record, image_bytes,
+                                      on_stage_complete=lambda stage: journal.mark_stage(record.id, stage),
+                                      previous_fingerprints=journal.uploaded_fingerprints(record.id) if incremental else None,
+                                      on_fingerprints=lambda fingerprints: journal.set_pending_fingerprints(record.id, fingerprints))
+            if documents:
+                journal.mark_enriched(record.id)
+            else:
+                journal.mark_unchanged(record.id)
+        latencies.append(time.monotonic() - started)
+        return documents
+
+    async for item, documents, error in bounded_map(worker,
+                                                   counted_records(),
+                                                   max_in_flight=max_in_flight,
+                                                   ordered=ordered):
+        if error is not None:
+            stage = error.stage if isinstance(error, StageFailedError) else None
+            # a local file that could not be read has no id
+            logging.warning(f"Error processing record {item.id or item.path}: {error}")
+            if journal is not None and item.id is not None:
+                journal.mark_failed(item.id, error, stage=stage)
+            recordResult.failedImageList.append(item)
+        else:
+            if journal is not None and documents:
+                # the record counts as uploaded only once its chunks are too
+                journal.expect_uploads(item.id, [document.id for document in documents])
+            # a partial update is staged neither for its parent nor for its chunks
+            stage = staging is not None and all(document.updatedFields is None for document in documents)
+            for document in documents:
+                if stage and not document.deleted:
+                    staging.append(document)
+                yield document
+
+    log_normalization_savings()
+    if deduplicator is not None and deduplicator.duplicates:
+        logging.info(f"Reused the enrichment of a near-duplicate image for {deduplicator.duplicates} records")
+    if latencies:
+        logging.info(f"Record latency p50 {percentile(latencies, 50):.1f}s, "
+                     f"p95 {percentile(latencies, 95):.1f}s, p99 {percentile(latencies, 99):.1f}s")
+
+def text_record_id(title: str, content: str, occurrence: int = 0) -> str:
+    """Id of a post without an id column, derived from its title so that editing its content keeps it.
+
+    A retitled post gets a new id and its old document stays in the index.
+    Posts sharing a title are told apart by ``occurrence``, their order in the
+    file. A post without a title can only be identified by its content.
+    """
+    key = title if title else "\x1econtent\x1f" + content
+    if occurrence:
+        key += f"\x1f{occurrence}"
+    return "text_" + content_hash(key)[:32]
+
+def iter_records(file_path: str, source: Optional[RecordSource] = None) -> Iterator[Union[ImageData, TextData]]:
+    """Records of ``file_path``, read lazily; lines that are not valid records are reported with their line number.
+
+    A record with an ``imageUrl`` is an image record, one with only a
+    ``title`` and/or ``content`` a text-only record.
+    """
+    if source is None:
+        source = RecordSource(file_path)
+    # posts seen so far per title, to tell apart those sharing one
+    title_counts: Dict[str, int] = {}
+    for line_number, fields in source:
+        if fields.get("imageUrl"):
+            if not fields.get("id"):
+                source.report(line_number, "missing id")
+                continue
+            yield ImageData(id=str(fields["id"]), imageUrl=str(fields["imageUrl"]), caption=str(fields.get("caption") or ""))
+        elif fields.get("title") or fields.get("content"):
+            title, content = str(fields.get("title") or ""), str(fields.get("content") or "")
+            record_id = fields.get("id")
+            if not record_id:
+                occurrence = 0
+                if title:
+                    occurrence = title_counts.get(title, 0)
+                    title_counts[title] = occurrence + 1
+                record_id = text_record_id(title, content, occurrence)
+            yield TextData(id=str(record_id), title=title, content=content)
+        else:
+            source.report(line_number, "neither an imageUrl nor a title or content")
+
+async def process_text_record(item: TextData, slots: ServiceSlots,
+                              on_stage_complete: Optional[Callable[[str], None]] = None,
+                              previous_fingerprints: Optional[Dict[str, str]] = None,
+                              on_fingerprints: Optional[Callable[[Dict[str, str]], None]] = None) -> List[Document]:
+    """Embed a post without an image: no vision stage, only text embeddings.
+
+    The Computer Vision text vector of its title (or the start of its content)
+    fills ``imageVecotor``, so the post also answers image-vector queries.
+    An unchanged record gives no documents when fingerprints are compared.
+    """
+    vectorize_text = (item.title or item.content)[:cv_text_max_chars]
+    if on_fingerprints is not None:
+        fingerprints = text_record_fingerprints(item, vectorize_text)
+        if not stale_fields(previous_fingerprints, fingerprints):
+            return []
+        on_fingerprints(fingerprints)
 
-    for item in image_data_list:
+    stages = [
+        Stage("captionVector", lambda: embed_text(item.title)),
+        Stage("contentVector", lambda: embed_text(item.content)),
+        Stage("imageVector", lambda: slots.run("cvVectorize", get_text_embedding_by_computer_vision(vectorize_text))),
+    ]
+    results = await run_stage_graph(stages, on_stage_complete=on_stage_complete)
+    return [Document(id=item.id,
+                     imageUrl="",
+                     caption=item.title,
+                     content=item.content,
+                     ocrContent="",
+                     captionVector=results["captionVector"],
+                     contentVector=results["contentVector"],
+                     ocrContentVecotor=None,
+                     imageVecotor=results["imageVector"])]
+
+async def _none() -> None:
+    return None
+
+def embed_text(text: Optional[str]) -> Awaitable[Optional[List[float]]]:
+    # the service rejects empty input, which would fail every text batched with it
+    return get_text_embedding_batched(text) if text and text.strip() else _none()
+
+async def process_image_record(item: ImageData, slots: ServiceSlots, download_once: bool = default_download_once,
+                               on_stage_complete: Optional[Callable[[str], None]] = None,
+                               deduplicator: Optional[ImageDeduplicator] = None,
+                               previous_fingerprints: Optional[Dict[str, str]] = None,
+                               on_fingerprints: Optional[Callable[[Dict[str, str]], None]] = None,
+                               image_bytes: Optional[bytes] = None) -> List[Document]:
+    """Enrich one record into its image document, followed by any OCR chunk documents.
+
+    ``image_bytes`` are used as they are when given (a local file), nothing is downloaded.
+
+    With ``on_fingerprints`` the record's field fingerprints are computed and
+    passed to it. Compared with ``previous_fingerprints`` (those of its last
+    upload), an unchanged record gives no documents and a changed one a
+    partial document of its stale fields. The number of chunk documents is
+    kept with the fingerprints, so chunks beyond a new, smaller count are
+    deleted from the index.
+    """
+    url = item.imageUrl
+    imageBytes = image_bytes
+
+    if imageBytes is None and download_once:
         try:
-            id = item.id
-            url = item.imageUrl
-            caption = item.caption
-
-            # create async tasks 
-            content_task = asyncio.create_task(get_content_by_mulit_model(url))
-            pdf_task = asyncio.create_task(download_and_save_as_pdf(url, pdf_dir))
-            caption_task = asyncio.create_task(get_image_caption_byCV(url))
-            image_embedding_task = asyncio.create_task(get_picture_embedding(url))
-
-            # wait for all tasks to complete
-            content = await content_task
-            pdfFileLocalPath = await pdf_task
-            captionByCV = await caption_task
-            imageVector = await image_embedding_task
-
-            # generate OCR content
-            ocrContent = await analyze_document(pdfFileLocalPath)
-
-            # get text embeddings task
-            captionVector_task = asyncio.create_task(get_text_embedding(captionByCV))
-            contentVector_task = asyncio.create_task(get_text_embedding(content))
-            ocrContentVector_task = asyncio.create_task(get_text_embedding(ocrContent + captionByCV))
-
-            # wait for all tasks to complete
-            captionVector = await captionVector_task
-            contentVector = await contentVector_task
-            ocrContentVector = await ocrContentVector_task
-            
-            # create a Document object and add it to the list
-            document = Document( id=id, 
-                                imageUrl=url, 
-                                caption=caption, 
-                                content=content, 
-                                ocrContent=ocrContent, 
-                                captionVector=captionVector, 
-                                contentVector=contentVector, 
-                                ocrContentVecotor=ocrContentVector, 
-                                imageVecotor=imageVector)
-        
-            documents.append(document)
+            imageBytes = await slots.run("download", download_image_bytes(url))
         except Exception as e:
-            print(f"Error processing record: {item.id}")
-            print(f"Error message: {e}")
-            errorRecords.append(item)
+            raise StageFailedError("imageBytes", e)
+        if on_stage_complete is not None:
+            on_stage_complete("imageBytes")
 
-    return recordResult
+    if on_fingerprints is not None:
+        fingerprints = record_fingerprints(item, image_identity(imageBytes, url))
+        changed = stale_fields(previous_fingerprints, fingerprints)
+        if not changed:
+            return []
+        if len(changed) < len(fingerprints):
+            documents = await update_image_record(item, slots, imageBytes, changed, on_stage_complete)
+        else:
+            documents = await enrich_image_record(item, slots, imageBytes, deduplicator, on_stage_complete)
+        previous_count = uploaded_chunk_count(previous_fingerprints)
+        if "ocrChunks" in changed:
+            count = sum(1 for document in documents if document.parentId is not None)
+            documents += chunk_deletions(item, count, previous_count or 0)
+        else:
+            count = previous_count
+        if count is not None:
+            fingerprints[chunk_count_key] = str(count)
+        on_fingerprints(fingerprints)
+        return documents
+
+    return await enrich_image_record(item, slots, imageBytes, deduplicator, on_stage_complete)
+
+async def enrich_image_record(item: ImageData, slots: ServiceSlots, imageBytes: Optional[bytes],
+                              deduplicator: Optional[ImageDeduplicator] = None,
+                              on_stage_complete: Optional[Callable[[str], None]] = None) -> List[Document]:
+    url = item.imageUrl
+    if imageBytes is not None:
+        enrich = lambda fields=None: enrich_image(url, slots, imageBytes, on_stage_complete, fields=fields)
+        if deduplicator is not None:
+            results = await deduplicator.run(imageBytes, item.id, enrich)
+        else:
+            results = await enrich()
+    else:
+        results = await enrich_image(url, slots, None, on_stage_complete)
+
+    # create a Document object; id, caption and URL always come from the record itself
+    document = Document( id=item.id, 
+                    imageUrl=url, 
+                    caption=item.caption, 
+                    content=results["content"], 
+                    ocrContent=results["ocrContent"], 
+                    captionVector=results["captionVector"], 
+                    contentVector=results["contentVector"], 
+                    ocrContentVecotor=results["ocrContentVector"], 
+                    imageVecotor=results["imageVector"])
+
+    return [document] + chunk_documents(item, results["ocrChunks"])
+
+def chunk_document_id(record_id: str, index: int) -> str:
+    return f"{record_id}_ocr_{index}"
+
+def chunk_documents(item: ImageData, chunks: List[Tuple[str, List[float]]]) -> List[Document]:
+    # long OCR text is searchable chunk by chunk through child documents
+    return [Document(id=chunk_document_id(item.id, index),
+                     imageUrl=item.imageUrl,
+                     caption=item.caption,
+                     content="",
+                     ocrContent=chunk,
+                     captionVector=None,
+                     contentVector=None,
+                     ocrContentVecotor=vector,
+                     imageVecotor=None,
+                     parentId=item.id)
+            for index, (chunk, vector) in enumerate(chunks)]
+
+def chunk_deletions(item: ImageData, count: int, previous_count: int) -> List[Document]:
+    # chunks of an earlier upload that the new chunking no longer produces
+    return [Document(**{**dict.fromkeys(document_fields), "id": chunk_document_id(item.id, index)}, deleted=True)
+            for index in range(count, previous_count)]
+
+async def update_image_record(item: ImageData, slots: ServiceSlots, image_bytes: Optional[bytes],
+                              changed: List[str],
+                              on_stage_complete: Optional[Callable[[str], None]] = None) -> List[Document]:
+    """Recompute only the ``changed`` fields of a record, as a partial document to merge into the index."""
+    derived = [name for name in _enrichment_fields if name in changed]
+    results = await enrich_image(item.imageUrl, slots, image_bytes, on_stage_complete, fields=derived) if derived else {}
+
+    values = {name: getattr(item, name) for name in record_fields if name in changed}
+    for name, value in results.items():
+        if name != "ocrChunks":
+            values[_document_field_names.get(name, name)] = value
+    # chunk documents are rebuilt whole; the caller deletes those beyond the new count
+    chunks = chunk_documents(item, results.get("ocrChunks", []))
+    if not values:
+        # only the chunks changed, the image document stays as it is
+        logging.info(f"Record {item.id} changed, updating its OCR chunks")
+        return chunks
+    logging.info(f"Record {item.id} changed, updating {', '.join(values)}")
+    document = Document(**{**dict.fromkeys(document_fields), **values, "id": item.id},
+                        updatedFields=tuple(values))
+    return [document] + chunks
+
+async def enrich_image(url: str, slots: ServiceSlots, image_bytes: Optional[bytes] = None,
+                       on_stage_complete: Optional[Callable[[str], None]] = None,
+                       fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Run the enrichment stages for one image, from its bytes when given, otherwise from its URL.
+
+    Only the stages needed for ``fields`` run when it is given.
+    """
+    # only an escalation to Document Intelligence takes one of its slots, READ text does not
+    run_layout = lambda call: slots.run("documentIntelligence", call)
+
+    # declare the enrichment stages; each starts as soon as its inputs are ready
+    if image_bytes is not None:
+        stages = [
+            # one resized, re-encoded copy per service
+            Stage("serviceImages", lambda: normalize_image_for_services(image_bytes)),
+            Stage("content",
+                  lambda serviceImages: slots.run("gpt4o", get_content_by_mulit_model_from_bytes(serviceImages["gpt4o"])),
+                  deps=["serviceImages"]),
+            Stage("imageAnalysis",
+                  lambda serviceImages: slots.run("cvCaption", analyze_image_byCV_from_bytes(serviceImages["imageAnalysis"])),
+                  deps=["serviceImages"]),
+            Stage("imageVector",
+                  lambda serviceImages: slots.run("cvVectorize", get_picture_embedding_from_bytes(serviceImages["vectorize"])),
+                  deps=["serviceImages"]),
+            # reuse the READ lines, escalating to Document Intelligence only when layout matters
+            Stage("ocrContent",
+                  lambda imageAnalysis, serviceImages: get_ocr_content(imageAnalysis, image_bytes=serviceImages["documentIntelligence"],
+                                                                       run_layout=run_layout),
+                  deps=["imageAnalysis", "serviceImages"]),
+        ]
+    else:
+        stages = [
+            Stage("content", lambda: slots.run("gpt4o", get_content_by_mulit_model(url))),
+            Stage("imageAnalysis", lambda: slots.run("cvCaption", analyze_image_byCV(url))),
+            Stage("imageVector", lambda: slots.run("cvVectorize", get_picture_embedding(url))),
+            # the image is only downloaded if OCR has to escalate to Document Intelligence
+            Stage("ocrContent",
+                  lambda imageAnalysis: get_ocr_content(imageAnalysis, image_url=url, run_layout=run_layout),
+                  deps=["imageAnalysis"]),
+        ]
+    stages += [
+        Stage("captionVector",
+              lambda imageAnalysis: embed_text(imageAnalysis.captionByCV),
+              deps=["imageAnalysis"]),
+        Stage("contentVector",
+              lambda content: embed_text(content),
+              deps=["content"]),
+        # cut the OCR text rather than the caption when the pair is over the token limit
+        Stage("ocrContentVector",
+              lambda ocrContent, imageAnalysis: embed_text(fit_with_suffix(ocrContent, imageAnalysis.captionByCV)),
+              deps=["ocrContent", "imageAnalysis"]),
+        Stage("ocrChunks", embed_text_chunks, deps=["ocrContent"]),
+    ]
+    fields = list(_enrichment_fields) if fields is None else fields
+    results = await run_stage_graph(select_stages(stages, fields), on_stage_complete=on_stage_complete)
+    return {name: results[name] for name in fields}
+
+async def embed_text_chunks(text: str) -> List[Tuple[str, List[float]]]:
+    """Embed overlapping token chunks of ``text``; empty unless chunking is on and the text spans several chunks."""
+    if not ocr_chunking_enabled:
+        return []
+    chunks = split_into_chunks(text)
+    if len(chunks) <= 1:
+        return []
+    vectors = await asyncio.gather(*(get_text_embedding_batched(chunk) for chunk in chunks))
+    return list(zip(chunks, vectors))
 
 if __name__ == "__main__":
     # 示例调用
-    recordResult = asyncio.run(process_images_records("multi-models/image_captions/ima_files_2_test.txt"))    
+    async def _main():
+        try:
+            return await process_images_records("multi-models/image_captions/ima_files_2_test.txt")
+        finally:
+            await close_clients()
+
+    recordResult = asyncio.run(_main())    
     print("recordResult: {}",recordResult)
\ No newline at end of file
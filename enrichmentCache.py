@@ -0,0 +1,188 @@
+"""Persistent, content-addressed cache for enrichment results.
+
+Entries are keyed by the SHA-256 of the input (image bytes, text or URL)
+together with the stage name and a version string that should change with
+the model or prompt. The cache lives in a local SQLite file and is trimmed
+by age and total size. Lookups and writes run in worker threads, so the
+event loop never waits on the disk.
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Any, Callable, List, Optional, Union
+
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+cache_enabled = os.getenv("ENRICHMENT_CACHE_ENABLED", "true").lower() == "true"
+cache_path = os.getenv("ENRICHMENT_CACHE_PATH", ".cache/enrichment.sqlite")
+cache_max_bytes = int(float(os.getenv("ENRICHMENT_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+cache_max_age_seconds = float(os.getenv("ENRICHMENT_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600
+cache_evict_every = int(os.getenv("ENRICHMENT_CACHE_EVICT_EVERY", "500"))
+
+
+def content_hash(payload: Union[bytes, str]) -> str:
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+def version_of(*parts: str) -> str:
+    # short fingerprint of model names, prompts and parameters
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class EnrichmentCache:
+    def __init__(self, path: str = cache_path, max_bytes: int = cache_max_bytes,
+                 max_age_seconds: float = cache_max_age_seconds, evict_every: int = cache_evict_every):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        # one connection shared by the worker threads
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL a commit no longer waits for the disk; a crash can only lose the last cache entries
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, stage TEXT NOT NULL, value BLOB NOT NULL,"
+            " size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._connection.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(stage: str, version: str, payload: Union[bytes, str]) -> str:
+        return f"{stage}:{version}:{content_hash(payload)}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._connection.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            return row[0]
+
+    def put(self, key: str, value: bytes):
+        stage = key.split(":", 1)[0]
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, stage, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, stage, value, len(value), now, now))
+            self._connection.commit()
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= self.evict_every:
+                self._evict()
+
+    async def get_async(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def put_async(self, key: str, value: bytes):
+        await asyncio.to_thread(self.put, key, value)
+
+    def evict(self):
+        """Drop entries older than the age limit, then least recently used ones until under the size limit."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        self._puts_since_evict = 0
+        expired = self._connection.execute("DELETE FROM entries WHERE created < ?",
+                                           (time.time() - self.max_age_seconds,)).rowcount
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        evicted = 0
+        if total > self.max_bytes:
+            for key, size in self._connection.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+        self._connection.commit()
+        if expired or evicted:
+            logging.info(f"Enrichment cache evicted {expired} expired and {evicted} least recently used entries")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_cache: Optional[EnrichmentCache] = None
+
+
+def get_enrichment_cache() -> Optional[EnrichmentCache]:
+    global _cache
+    if not cache_enabled:
+        return None
+    if _cache is None:
+        _cache = EnrichmentCache()
+    return _cache
+
+
+def encode_json(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def decode_json(value: bytes) -> Any:
+    return json.loads(value.decode("utf-8"))
+
+
+def encode_vector(vector: List[float]) -> bytes:
+    # float32 is what the index stores anyway, at a quarter of the JSON size
+    return array("f", vector).tobytes()
+
+
+def decode_vector(value: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(value)
+    return vector.tolist()
+
+
+def cached(stage: str, version: str,
+           encode: Callable[[Any], bytes] = encode_json,
+           decode: Callable[[bytes], Any] = decode_json):
+    """Cache an async enrichment function keyed on its first argument.
+
+    The first argument (image bytes, text or URL) is hashed together with
+    ``stage`` and ``version``; bump ``version`` when the model or prompt
+    changes so stale entries are no longer served.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(payload, *args, **kwargs):
+            cache = get_enrichment_cache()
+            if cache is None:
+                return await func(payload, *args, **kwargs)
+            # hashing large images releases the GIL, so it goes to the thread with the lookup
+            key = await asyncio.to_thread(cache.make_key, stage, version, payload)
+            hit = await cache.get_async(key)
+            if hit is not None:
+                return decode(hit)
+            value = await func(payload, *args, **kwargs)
+            await cache.put_async(key, encode(value))
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,224 @@
+"""Perceptual-hash deduplication of images before enrichment.
+
+Each downloaded image gets a 64-bit difference hash (dHash). An image within
+``IMAGE_DEDUP_MAX_DISTANCE`` bits of an image already seen in this run reuses
+that image's image vector. Its text (description, caption, OCR) is only
+reused when the bytes are identical: near-identical screenshots often differ
+in exactly that text.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from dotenv import load_dotenv
+from PIL import Image
+
+from cpuOffload import run_cpu_bound
+from objectDefinition import to_float32
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+image_dedup_enabled = os.getenv("IMAGE_DEDUP_ENABLED", "true").lower() == "true"
+image_dedup_max_distance = int(os.getenv("IMAGE_DEDUP_MAX_DISTANCE", "2"))
+# enrichment results a near-duplicate with different bytes may share; anything read off the image is redone
+near_duplicate_shared_fields = ("imageVector",)
+# finished enrichments kept for reuse; the oldest are dropped first
+image_dedup_max_entries = int(os.getenv("IMAGE_DEDUP_MAX_ENTRIES", "5000"))
+
+hash_size = 8
+hash_bits = hash_size * hash_size
+
+
+def dhash(image_bytes: bytes) -> int:
+    """64-bit difference hash: whether each pixel is brighter than its right neighbour."""
+    image = Image.open(BytesIO(image_bytes))
+    # lets the JPEG decoder downscale while decoding
+    image.draft("L", (hash_size * 16, hash_size * 16))
+    pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            offset = row * (hash_size + 1) + col
+            bits = (bits << 1) | (pixels[offset] > pixels[offset + 1])
+    return bits
+
+
+def image_hashes(image_bytes: bytes) -> Tuple[int, str]:
+    # the byte hash tells identical copies from merely similar images
+    return dhash(image_bytes), hashlib.sha256(image_bytes).hexdigest()
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class NearDuplicateIndex:
+    """Finds stored hashes within ``max_distance`` bits of a query.
+
+    Hashes are split into ``max_distance + 1`` bands; two hashes that differ
+    in at most ``max_distance`` bits agree exactly on at least one band, so
+    only hashes sharing a band are compared.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max(0, min(max_distance, hash_bits - 1))
+        band_count = self.max_distance + 1
+        widths = [hash_bits // band_count + (1 if i < hash_bits % band_count else 0) for i in range(band_count)]
+        self._bands: List[Tuple[int, int]] = []
+        shift = 0
+        for width in widths:
+            self._bands.append((shift, (1 << width) - 1))
+            shift += width
+        self._buckets: List[Dict[int, Set[int]]] = [{} for _ in self._bands]
+        self._keys: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def find(self, image_hash: int) -> Optional[str]:
+        best: Optional[Tuple[int, str]] = None
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            for candidate in buckets.get((image_hash >> shift) & mask, ()):
+                distance = hamming_distance(image_hash, candidate)
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, self._keys[candidate])
+        return best[1] if best else None
+
+    def add(self, image_hash: int, key: str):
+        if image_hash in self._keys:
+            return
+        self._keys[image_hash] = key
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            buckets.setdefault((image_hash >> shift) & mask, set()).add(image_hash)
+
+    def remove(self, image_hash: int):
+        if self._keys.pop(image_hash, None) is None:
+            return
+        for buckets, (shift, mask) in zip(self._buckets, self._bands):
+            band = (image_hash >> shift) & mask
+            buckets[band].discard(image_hash)
+            if not buckets[band]:
+                del buckets[band]
+
+
+def _pack_value(value: Any) -> Any:
+    # float32 arrays take an eighth of the memory of float lists
+    if isinstance(value, list) and value:
+        if isinstance(value[0], float):
+            return to_float32(value)
+        if isinstance(value[0], tuple):
+            return [tuple(_pack_value(part) for part in item) for item in value]
+    return value
+
+
+def _pack(results: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: _pack_value(value) for name, value in results.items()}
+
+
+def _unpack(results: Dict[str, Any]) -> Dict[str, Any]:
+    # Document keeps float32 arrays as they are, so duplicates share them
+    return dict(results)
+
+
+class ImageDeduplicator:
+    """Shares enrichment results between near-duplicate images of one run."""
+
+    def __init__(self, max_distance: int = image_dedup_max_distance, max_entries: int = image_dedup_max_entries):
+        self.index = NearDuplicateIndex(max_distance)
+        self.max_entries = max_entries
+        self.duplicates = 0
+        self._hashes: Dict[str, int] = {}
+        self._digests: Dict[str, str] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._finished: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    async def _shared_result(self, key: str) -> Optional[Dict[str, Any]]:
+        if key in self._finished:
+            self._finished.move_to_end(key)
+            return _unpack(self._finished[key])
+        future = self._in_flight.get(key)
+        if future is None:
+            return None
+        try:
+            return _unpack(await asyncio.shield(future))
+        except asyncio.CancelledError:
+            # the original's enrichment was cancelled, not this caller
+            if future.cancelled():
+                return None
+            raise
+        except Exception:
+            return None
+
+    def _forget(self, key: str):
+        self.index.remove(self._hashes.pop(key))
+        self._digests.pop(key, None)
+        self._finished.pop(key, None)
+
+    async def run(self, image_bytes: bytes, record_id: str,
+                  enrich: Callable[[Optional[Sequence[str]]], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Return ``enrich(None)`` for the image, reusing what a duplicate seen before allows.
+
+        ``enrich(fields)`` computes only ``fields`` (all of them for None).
+        """
+        try:
+            image_hash, digest = await run_cpu_bound(image_hashes, image_bytes, size=len(image_bytes))
+        except Exception as e:
+            logging.warning(f"Could not hash image of record {record_id}, enriching it without dedup: {e}")
+            return await enrich(None)
+
+        match = self.index.find(image_hash)
+        if match is None and record_id in self._hashes:
+            # a repeated record id keeps its first registration
+            return await enrich(None)
+        if match is not None:
+            shared = await self._shared_result(match)
+            if shared is None:
+                # the original failed or was dropped, this copy is enriched on its own
+                return await enrich(None)
+            self.duplicates += 1
+            if self._digests.get(match) == digest:
+                logging.info(f"Record {record_id} is a copy of {match}, reusing its enrichment")
+                return shared
+            logging.info(f"Record {record_id} is a near-duplicate of {match}, reusing its image vector")
+            reused = {name: shared[name] for name in near_duplicate_shared_fields if name in shared}
+            return {**reused, **await enrich([name for name in shared if name not in reused])}
+
+        future = asyncio.get_running_loop().create_future()
+        self.index.add(image_hash, record_id)
+        self._hashes[record_id] = image_hash
+        self._digests[record_id] = digest
+        self._in_flight[record_id] = future
+        try:
+            results = await enrich(None)
+        except BaseException as e:
+            self._in_flight.pop(record_id)
+            self._forget(record_id)
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                future.exception()  # waiters handle it, don't warn about an unretrieved exception
+            else:
+                future.cancel()
+            raise
+        packed = _pack(results)
+        future.set_result(packed)
+        self._in_flight.pop(record_id)
+        self._finished[record_id] = packed
+        while len(self._finished) > self.max_entries:
+            self._forget(next(iter(self._finished)))
+        return results
+
+
+if __name__ == "__main__":
+    # 示例调用
+    original = Image.radial_gradient("L").resize((640, 480)).rotate(30).convert("RGB")
+    first, second = BytesIO(), BytesIO()
+    original.save(first, format="PNG")
+    original.resize((320, 240)).save(second, format="JPEG", quality=70)
+    a, b = dhash(first.getvalue()), dhash(second.getvalue())
+    print(f"{a:016x} {b:016x} distance {hamming_distance(a, b)}")
@@ -0,0 +1,198 @@
+"""Concurrent, size-aware uploads to an Azure AI Search index over the REST API.
+
+Documents are serialized once, grouped into batches bounded by byte size and
+document count, and several batches are sent at a time over the shared HTTP
+pool. Only the keys the service reports as failed are sent again.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from azure.core.credentials import AzureKeyCredential
+from dotenv import load_dotenv
+
+from rateLimiter import ServiceStatusError, parse_retry_after, rate_limited
+from serviceClients import close_clients, get_http_session
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+search_api_version = os.getenv("SEARCH_API_VERSION", "2024-07-01")
+# the service accepts at most 1000 documents and 16 MB per request
+upload_max_batch_docs = min(int(os.getenv("UPLOAD_MAX_BATCH_DOCS", "1000")), 1000)
+upload_max_batch_bytes = int(float(os.getenv("UPLOAD_MAX_BATCH_MB", "8")) * 1024 * 1024)
+upload_max_concurrency = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "4"))
+upload_max_retries = int(os.getenv("UPLOAD_MAX_RETRIES", "5"))
+
+# per-document statuses in a 207 answer that are worth sending again
+_retryable_document_status = {409, 422, 429, 503}
+_search_scope = "https://search.azure.com/.default"
+
+
+def serialize_document(document: Dict[str, Any]) -> bytes:
+    return json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class IndexUploader:
+    """Uploads serialized documents in concurrent batches.
+
+    ``add`` waits while ``max_concurrency`` batches are in flight, which
+    pushes back on the producer. ``on_uploaded(keys)`` and
+    ``on_failed(key, error)`` report the outcome of every key.
+    """
+
+    def __init__(self, endpoint: str, index_name: str, credential,
+                 max_batch_docs: int = upload_max_batch_docs,
+                 max_batch_bytes: int = upload_max_batch_bytes,
+                 max_concurrency: int = upload_max_concurrency,
+                 max_retries: int = upload_max_retries,
+                 on_uploaded: Optional[Callable[[List[str]], None]] = None,
+                 on_failed: Optional[Callable[[str, str], None]] = None):
+        self.url = f"{endpoint.rstrip('/')}/indexes/{index_name}/docs/index?api-version={search_api_version}"
+        self.credential = credential
+        self.max_batch_docs = max_batch_docs
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.on_uploaded = on_uploaded
+        self.on_failed = on_failed
+
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.failed: Dict[str, str] = {}
+        self._batch: List[Tuple[str, bytes]] = []
+        self._batch_bytes = 0
+        # monotonic time the oldest document of the current batch was added
+        self.oldest_pending: Optional[float] = None
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+        self._token = None
+        self._started = None
+
+    async def _headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if isinstance(self.credential, AzureKeyCredential):
+            headers["api-key"] = self.credential.key
+            return headers
+        if self._token is None or self._token.expires_on - time.time() < 300:
+            self._token = await asyncio.to_thread(self.credential.get_token, _search_scope)
+        headers["Authorization"] = f"Bearer {self._token.token}"
+        return headers
+
+    async def add(self, document: Dict[str, Any]):
+        await self.add_serialized(str(document["id"]), serialize_document(document))
+
+    async def add_serialized(self, key: str, payload: bytes):
+        if self._started is None:
+            self._started = time.monotonic()
+        if self._batch and (len(self._batch) >= self.max_batch_docs
+                            or self._batch_bytes + len(payload) + 1 > self.max_batch_bytes):
+            await self.flush()
+        if not self._batch:
+            self.oldest_pending = time.monotonic()
+        self._batch.append((key, payload))
+        self._batch_bytes += len(payload) + 1
+
+    async def flush(self):
+        """Start sending the current batch, waiting for a free slot first."""
+        if not self._batch:
+            return
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        self.oldest_pending = None
+        await self._slots.acquire()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Send what is left and wait for every batch to finish."""
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self._started if self._started is not None else 0
+        rate = f", {self.uploaded / elapsed:.1f} docs/s, {self.uploaded_bytes / elapsed / 1e6:.2f} MB/s" if elapsed else ""
+        logging.info(f"Uploaded {self.uploaded} documents ({self.uploaded_bytes / 1e6:.1f} MB) "
+                     f"in {elapsed:.1f}s{rate}, {len(self.failed)} failed")
+
+    @rate_limited("search")
+    async def _post(self, body: bytes) -> Tuple[int, Dict[str, Any]]:
+        session = get_http_session()
+        async with session.post(self.url, headers=await self._headers(), data=body) as response:
+            if response.status in (200, 207):
+                return response.status, await response.json()
+            error_text = await response.text()
+            raise ServiceStatusError(f"Error uploading documents: {response.status} - {error_text}",
+                                     response.status, parse_retry_after(response.headers))
+
+    async def _send(self, batch: List[Tuple[str, bytes]]):
+        try:
+            await self._send_with_retries(batch)
+        finally:
+            self._slots.release()
+
+    async def _send_with_retries(self, batch: List[Tuple[str, bytes]]):
+        for attempt in range(self.max_retries + 1):
+            body = b'{"value":[' + b",".join(payload for _, payload in batch) + b"]}"
+            try:
+                _, answer = await self._post(body)
+            except ServiceStatusError as e:
+                if e.status_code == 413 and len(batch) > 1:
+                    # too large after all, halve it
+                    middle = len(batch) // 2
+                    await asyncio.gather(self._send_with_retries(batch[:middle]),
+                                         self._send_with_retries(batch[middle:]))
+                    return
+                self._fail(batch, str(e))
+                return
+            except Exception as e:
+                self._fail(batch, str(e))
+                return
+
+            by_key = dict(batch)
+            succeeded, retry = [], []
+            for result in answer.get("value", []):
+                key = result["key"]
+                if result.get("status"):
+                    succeeded.append(key)
+                elif result.get("statusCode") in _retryable_document_status and attempt < self.max_retries:
+                    retry.append((key, by_key[key]))
+                else:
+                    self._fail([(key, by_key[key])], result.get("errorMessage") or f"status {result.get('statusCode')}")
+            self.uploaded += len(succeeded)
+            self.uploaded_bytes += sum(len(by_key[key]) for key in succeeded)
+            if succeeded and self.on_uploaded is not None:
+                self.on_uploaded(succeeded)
+            if not retry:
+                return
+            delay = min(60.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+            logging.warning(f"Retrying {len(retry)} of {len(batch)} documents in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            batch = retry
+
+    def _fail(self, batch: List[Tuple[str, bytes]], error: str):
+        logging.error(f"Indexing failed for {len(batch)} documents: {error}")
+        for key, _ in batch:
+            self.failed[key] = error
+            if self.on_failed is not None:
+                self.on_failed(key, error)
+
+
+if __name__ == "__main__":
+    # 示例调用
+    async def _main():
+        uploader = IndexUploader(os.getenv("AZURE_SEARCH_SERVICE_ENDPOINT"), os.getenv("AZURE_SEARCH_INDEX"),
+                                 AzureKeyCredential(os.getenv("AZURE_COGNITIVE_SEARCH_KEY")))
+        try:
+            await uploader.add({"@search.action": "mergeOrUpload", "id": "example", "caption": "example"})
+            await uploader.close()
+        finally:
+            await close_clients()
+
+    asyncio.run(_main())
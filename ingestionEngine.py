@@ -0,0 +1,157 @@
+"""Bounded-concurrency helpers for the ingestion pipeline."""
+import asyncio
+import logging
+import os
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# global number of records in flight at the same time
+default_max_in_flight = int(os.getenv("INGEST_MAX_IN_FLIGHT", "16"))
+# per-service in-flight limits, e.g. "gpt4o=4,documentIntelligence=8"
+default_service_limits = os.getenv("INGEST_SERVICE_LIMITS", "")
+
+
+def parse_service_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        service, _, value = part.partition("=")
+        limits[service.strip()] = int(value)
+    return limits
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile of ``values``, e.g. ``pct=99`` for p99."""
+    if not values:
+        raise ValueError("percentile of an empty sequence")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(len(ordered) * pct / 100)) - 1))]
+
+
+class ServiceSlots:
+    """Caps the number of concurrent calls per downstream service.
+
+    Services without an explicit limit fall back to ``default_limit``; ``None``
+    means unlimited.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None, default_limit: Optional[int] = None):
+        self.limits = dict(limits) if limits is not None else parse_service_limits(default_service_limits)
+        self.default_limit = default_limit
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _semaphore(self, service: str) -> Optional[asyncio.Semaphore]:
+        limit = self.limits.get(service, self.default_limit)
+        if limit is None:
+            return None
+        if service not in self._semaphores:
+            self._semaphores[service] = asyncio.Semaphore(limit)
+        return self._semaphores[service]
+
+    async def run(self, service: str, awaitable: Awaitable[R]) -> R:
+        semaphore = self._semaphore(service)
+        if semaphore is None:
+            return await awaitable
+        async with semaphore:
+            return await awaitable
+
+
+async def bounded_map(worker: Callable[[T], Awaitable[R]],
+                      items: Iterable[T],
+                      max_in_flight: int = default_max_in_flight,
+                      ordered: bool = True,
+                      reorder_window: Optional[int] = None) -> AsyncIterator[Tuple[T, Optional[R], Optional[BaseException]]]:
+    """Run ``worker`` over ``items`` with at most ``max_in_flight`` calls pending.
+
+    Yields ``(item, result, error)`` tuples. With ``ordered=True`` results come
+    back in input order; ``reorder_window`` bounds how far submission may run
+    ahead of the oldest unfinished item so the reorder buffer stays small.
+    Items are pulled lazily, so ``items`` may be a generator.
+    """
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least 1")
+    if reorder_window is None:
+        reorder_window = max_in_flight * 4
+
+    iterator = iter(items)
+    pending: Dict[asyncio.Task, Tuple[int, T]] = {}
+    finished: Dict[int, Tuple[T, Any, Optional[BaseException]]] = {}
+    next_index = 0
+    next_to_yield = 0
+    exhausted = False
+
+    try:
+        while True:
+            # top up the in-flight set
+            while not exhausted and len(pending) < max_in_flight:
+                if ordered and next_index - next_to_yield >= reorder_window:
+                    break
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                task = asyncio.create_task(worker(item))
+                pending[task] = (next_index, item)
+                next_index += 1
+
+            if not pending:
+                break
+
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index, item = pending.pop(task)
+                if task.cancelled():
+                    outcome = (item, None, asyncio.CancelledError())
+                elif task.exception() is not None:
+                    outcome = (item, None, task.exception())
+                else:
+                    outcome = (item, task.result(), None)
+
+                if ordered:
+                    finished[index] = outcome
+                else:
+                    yield outcome
+
+            while next_to_yield in finished:
+                yield finished.pop(next_to_yield)
+                next_to_yield += 1
+    finally:
+        for task in pending:
+            task.cancel()
+        # wait for the cancellations, so no task is destroyed pending or leaves its exception unretrieved
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    # 示例调用
+    async def _square(x: int) -> int:
+        await asyncio.sleep(0.01 * (5 - x % 5))
+        return x * x
+
+    async def _main():
+        async for item, result, error in bounded_map(_square, range(10), max_in_flight=3):
+            print(item, result, error)
+
+    asyncio.run(_main())
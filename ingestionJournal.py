@@ -0,0 +1,196 @@
+"""Durable per-record checkpoint journal for resumable ingestion."""
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+from objectDefinition import ImageData, TextData
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+STATUS_STARTED = "started"
+STATUS_ENRICHED = "enriched"
+STATUS_UPLOADED = "uploaded"
+STATUS_FAILED = "failed"
+# nothing changed since the last upload, so nothing was sent
+STATUS_UNCHANGED = "unchanged"
+
+
+def default_journal_path(index_name: str) -> str:
+    return os.path.join(".cache", f"ingest-journal-{index_name or 'default'}.sqlite")
+
+
+class IngestionJournal:
+    """Records, per record id, which stages finished and whether it was uploaded.
+
+    Every change is committed immediately, so an interrupted run can resume
+    from the journal. Stage results themselves live in the enrichment cache.
+    The field fingerprints of the last upload of each document outlive
+    ``reset``, so the next run can tell which fields changed.
+
+    A record announced with ``expect_uploads`` counts as uploaded only once
+    every one of its documents (its OCR chunks included) was; upload results
+    are reported per document key and mapped back to the record.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " id TEXT PRIMARY KEY, imageUrl TEXT, status TEXT NOT NULL, stages TEXT NOT NULL,"
+            " failedStage TEXT, error TEXT, updated REAL NOT NULL)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            " id TEXT PRIMARY KEY, uploaded TEXT, pending TEXT)")
+        self._connection.commit()
+        # record id of each document key still being uploaded, and the keys each record still waits for
+        self._record_of: Dict[str, str] = {}
+        self._awaiting: Dict[str, Set[str]] = {}
+        self._upload_failed: Set[str] = set()
+
+    def reset(self):
+        self._connection.execute("DELETE FROM records")
+        self._connection.commit()
+
+    def is_uploaded(self, record_id: str) -> bool:
+        row = self._connection.execute("SELECT status FROM records WHERE id = ?", (record_id,)).fetchone()
+        return row is not None and row[0] in (STATUS_UPLOADED, STATUS_UNCHANGED)
+
+    def completed_stages(self, record_id: str) -> List[str]:
+        row = self._connection.execute("SELECT stages FROM records WHERE id = ?", (record_id,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def mark_started(self, item: Union[ImageData, TextData]):
+        # keep stages from an earlier attempt, they tell us what the cache should serve
+        self._connection.execute(
+            "INSERT INTO records (id, imageUrl, status, stages, updated) VALUES (?, ?, ?, '[]', ?)"
+            " ON CONFLICT(id) DO UPDATE SET status = excluded.status, failedStage = NULL, error = NULL,"
+            " updated = excluded.updated",
+            (item.id, getattr(item, "imageUrl", None), STATUS_STARTED, time.time()))
+        self._connection.commit()
+
+    def mark_stage(self, record_id: str, stage: str):
+        stages = self.completed_stages(record_id)
+        if stage not in stages:
+            stages.append(stage)
+            self._connection.execute("UPDATE records SET stages = ?, updated = ? WHERE id = ?",
+                                     (json.dumps(stages), time.time(), record_id))
+            self._connection.commit()
+
+    def mark_enriched(self, record_id: str):
+        self._set_status(record_id, STATUS_ENRICHED)
+
+    def mark_unchanged(self, record_id: str):
+        self._set_status(record_id, STATUS_UNCHANGED)
+        # a change that needed no document to be sent is as good as uploaded
+        self._promote_fingerprints([record_id])
+
+    def expect_uploads(self, record_id: str, keys: Iterable[str]):
+        """Announce the keys of every document of ``record_id`` before they are uploaded."""
+        keys = set(keys)
+        self._awaiting[record_id] = keys
+        for key in keys:
+            self._record_of[key] = record_id
+
+    def _finished_records(self, keys: Iterable[str]) -> List[str]:
+        finished = []
+        for key in keys:
+            record_id = self._record_of.pop(key, key)
+            awaiting = self._awaiting.get(record_id)
+            if awaiting is None:
+                if record_id not in self._upload_failed:
+                    finished.append(record_id)
+                continue
+            awaiting.discard(key)
+            if not awaiting:
+                del self._awaiting[record_id]
+                finished.append(record_id)
+        return finished
+
+    def mark_uploaded(self, keys: Iterable[str]):
+        """Record the document keys that were uploaded; a record is done once all its documents are."""
+        now = time.time()
+        record_ids = self._finished_records(keys)
+        self._connection.executemany("UPDATE records SET status = ?, updated = ? WHERE id = ?",
+                                     [(STATUS_UPLOADED, now, record_id) for record_id in record_ids])
+        self._promote_fingerprints(record_ids)
+
+    def _promote_fingerprints(self, record_ids: List[str]):
+        # the fingerprints of what was just sent become the ones to compare against
+        self._connection.executemany(
+            "UPDATE fingerprints SET uploaded = pending, pending = NULL WHERE id = ? AND pending IS NOT NULL",
+            [(record_id,) for record_id in record_ids])
+        self._connection.commit()
+
+    def uploaded_fingerprints(self, record_id: str) -> Optional[Dict[str, str]]:
+        row = self._connection.execute("SELECT uploaded FROM fingerprints WHERE id = ?", (record_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def set_pending_fingerprints(self, record_id: str, fingerprints: Dict[str, str]):
+        """Remember the fingerprints of a document about to be uploaded; ``mark_uploaded`` keeps them."""
+        self._connection.execute(
+            "INSERT INTO fingerprints (id, pending) VALUES (?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET pending = excluded.pending",
+            (record_id, json.dumps(fingerprints)))
+        self._connection.commit()
+
+    def mark_failed(self, record_id: str, error: BaseException, stage: Optional[str] = None):
+        """Mark a record failed; a document key of an announced record fails that record."""
+        key = record_id
+        record_id = self._record_of.pop(key, key)
+        if self._awaiting.pop(record_id, None) is not None or record_id != key:
+            # its other documents may still succeed, which must not mark it uploaded
+            self._upload_failed.add(record_id)
+        self._connection.execute(
+            "UPDATE records SET status = ?, failedStage = ?, error = ?, updated = ? WHERE id = ?",
+            (STATUS_FAILED, stage, str(error), time.time(), record_id))
+        self._connection.commit()
+
+    def _set_status(self, record_id: str, status: str):
+        self._connection.execute("UPDATE records SET status = ?, updated = ? WHERE id = ?",
+                                 (status, time.time(), record_id))
+        self._connection.commit()
+
+    def counts(self) -> dict:
+        return dict(self._connection.execute("SELECT status, COUNT(*) FROM records GROUP BY status").fetchall())
+
+    def write_failure_report(self, report_path: str) -> int:
+        """Write one JSON line per failed or unfinished record; returns how many."""
+        rows = self._connection.execute(
+            "SELECT id, imageUrl, status, stages, failedStage, error FROM records"
+            " WHERE status NOT IN (?, ?) ORDER BY id", (STATUS_UPLOADED, STATUS_UNCHANGED)).fetchall()
+        directory = os.path.dirname(report_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as report:
+            for record_id, image_url, status, stages, failed_stage, error in rows:
+                report.write(json.dumps({"id": record_id,
+                                         "imageUrl": image_url,
+                                         "status": status,
+                                         "completedStages": json.loads(stages),
+                                         "failedStage": failed_stage,
+                                         "error": error}, ensure_ascii=False) + "\n")
+        logging.info(f"Wrote {len(rows)} failed or unfinished records to {report_path}")
+        return len(rows)
+
+    def close(self):
+        self._connection.close()
+
+
+if __name__ == "__main__":
+    # 示例调用
+    journal = IngestionJournal(default_journal_path("example"))
+    journal.mark_started(ImageData(id="1", imageUrl="https://example.com/1.png", caption="example"))
+    journal.mark_stage("1", "imageAnalysis")
+    journal.mark_failed("1", Exception("timeout"), stage="content")
+    print(journal.counts(), journal.completed_stages("1"))
+    journal.write_failure_report("failed_records.jsonl")
+    journal.close()
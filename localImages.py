@@ -0,0 +1,89 @@
+"""Local image files as records: a directory or glob instead of a caption file.
+
+Files are read in a bounded thread pool and identified by the hash of their
+bytes, which go to the analyzers directly; nothing has to be hosted first.
+"""
+import asyncio
+import glob
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from dotenv import load_dotenv
+
+from enrichmentCache import content_hash
+from objectDefinition import LocalImageData
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# files read at the same time
+local_read_workers = int(os.getenv("LOCAL_READ_WORKERS", "8"))
+local_image_extensions = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff", ".webp"}
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def is_local_image_source(path: str) -> bool:
+    """Whether ``path`` names local images (a directory, a glob or one image) rather than a record file."""
+    return (os.path.isdir(path) or glob.has_magic(path)
+            or os.path.splitext(path)[1].lower() in local_image_extensions)
+
+
+def iter_local_images(path: str) -> Iterator[LocalImageData]:
+    """Image files under a directory (recursively) or matching a glob, in a stable order."""
+    if os.path.isdir(path):
+        def walk():
+            for root, directories, files in os.walk(path):
+                directories.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        paths = walk()
+    else:
+        paths = iter(sorted(glob.iglob(path, recursive=True)))
+    for file_path in paths:
+        if os.path.splitext(file_path)[1].lower() in local_image_extensions and os.path.isfile(file_path):
+            yield LocalImageData(path=file_path, caption=os.path.splitext(os.path.basename(file_path))[0])
+
+
+def get_read_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=local_read_workers, thread_name_prefix="read")
+    return _executor
+
+
+def _read_and_hash(path: str):
+    with open(path, "rb") as file:
+        data = file.read()
+    # hashing in the worker keeps large files off the event loop too
+    return data, content_hash(data)
+
+
+async def read_local_image(item: LocalImageData) -> bytes:
+    """Read the file of ``item`` in the read pool and set its id from the hash of its bytes."""
+    data, digest = await asyncio.get_running_loop().run_in_executor(get_read_executor(), _read_and_hash, item.path)
+    item.id = "local_" + digest[:32]
+    return data
+
+
+def shutdown_read_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+if __name__ == "__main__":
+    # 示例调用
+    async def _main():
+        for item in iter_local_images("docs/images"):
+            data = await read_local_image(item)
+            print(item.id, item.path, len(data))
+
+    try:
+        asyncio.run(_main())
+    finally:
+        shutdown_read_executor()
@@ -0,0 +1,118 @@
+"""Collects concurrent single-item requests into batched service calls."""
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, List, Optional, Tuple, TypeVar
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """Gathers items from concurrent callers and sends them to ``flush`` together.
+
+    A batch is flushed when it reaches ``max_batch_size`` items, when adding an
+    item would push its total weight past ``max_batch_weight``, or
+    ``max_delay`` seconds after its first item arrived. ``flush`` must return
+    one result per item, in order; each caller gets its own result back, and
+    an exception in a result slot is raised to that caller only.
+    ``max_concurrent_batches`` caps how many flushes run at once.
+    """
+
+    def __init__(self,
+                 flush: Callable[[List[T]], Awaitable[List[R]]],
+                 max_batch_size: int = 16,
+                 max_batch_weight: Optional[int] = None,
+                 weigh: Optional[Callable[[T], int]] = None,
+                 max_delay: float = 0.05,
+                 max_concurrent_batches: Optional[int] = None):
+        self._flush = flush
+        self.max_batch_size = max_batch_size
+        self.max_batch_weight = max_batch_weight
+        self._weigh = weigh or (lambda item: 1)
+        self.max_delay = max_delay
+        self._pending: List[Tuple[T, asyncio.Future]] = []
+        self._pending_weight = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._batch_slots = asyncio.Semaphore(max_concurrent_batches) if max_concurrent_batches else None
+        self._inflight = set()
+        self.batches_sent = 0
+        self.items_sent = 0
+
+    async def submit(self, item: T) -> R:
+        loop = asyncio.get_running_loop()
+        weight = self._weigh(item)
+        if (self._pending and self.max_batch_weight is not None
+                and self._pending_weight + weight > self.max_batch_weight):
+            self._dispatch()
+
+        future = loop.create_future()
+        self._pending.append((item, future))
+        self._pending_weight += weight
+
+        if (len(self._pending) >= self.max_batch_size
+                or (self.max_batch_weight is not None and self._pending_weight >= self.max_batch_weight)):
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._dispatch)
+
+        return await future
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_weight = self._pending, [], 0
+        task = asyncio.ensure_future(self._send(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, batch: List[Tuple[T, asyncio.Future]]):
+        items = [item for item, _ in batch]
+        self.batches_sent += 1
+        self.items_sent += len(items)
+        try:
+            if self._batch_slots is not None:
+                async with self._batch_slots:
+                    results = await self._flush(items)
+            else:
+                results = await self._flush(items)
+            if len(results) != len(items):
+                raise Exception(f"Batch returned {len(results)} results for {len(items)} items")
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            # a batch may fail for some items only
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def drain(self):
+        """Flush whatever is pending and wait for every batch in flight."""
+        self._dispatch()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    # 示例调用
+    async def _echo(items):
+        print("flushing", items)
+        return [item.upper() for item in items]
+
+    async def _main():
+        batcher = MicroBatcher(_echo, max_batch_size=3)
+        print(await asyncio.gather(*(batcher.submit(word) for word in "abcdefg")))
+
+    asyncio.run(_main())
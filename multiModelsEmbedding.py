@@ -3,9 +3,12 @@ import logging
 import os
 from typing import List
 
-import aiohttp
 from dotenv import load_dotenv
 
+from enrichmentCache import cached, decode_vector, encode_vector, version_of
+from rateLimiter import ServiceStatusError, parse_retry_after, rate_limited
+from serviceClients import close_clients, get_http_session
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -14,6 +17,10 @@ load_dotenv(verbose=True)
 endpoint = os.getenv("AZURE_COMPUTER_VISION_ENDPOINT")
 key = os.getenv("AZURE_COMPUTER_VISION_KEY")
 
+vectorize_cache_version = version_of("2024-02-01", "2023-04-15")
+
+@cached("imageVector", vectorize_cache_version, encode=encode_vector, decode=decode_vector)
+@rate_limited("computerVision")
 async def get_picture_embedding(image_file_url:str) ->  List[float]:
     logging.info(f"Getting picture embedding for {image_file_url}")
 
@@ -26,17 +33,43 @@ async def get_picture_embedding(image_file_url:str) ->  List[float]:
         "url": image_file_url
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=body) as response:
-            if response.status == 200:
-                data = await response.json()
-                return data['vector']
-            else:
-                error_text = await response.text()
-                logging.error(f"Error getting picture embedding: {response.status} - {error_text}")
-                raise Exception(f"Error getting picture embedding: {response.status} - {error_text}")
+    session = get_http_session()
+    async with session.post(url, headers=headers, json=body) as response:
+        if response.status == 200:
+            data = await response.json()
+            return data['vector']
+        else:
+            error_text = await response.text()
+            logging.error(f"Error getting picture embedding: {response.status} - {error_text}")
+            raise ServiceStatusError(f"Error getting picture embedding: {response.status} - {error_text}",
+                                     response.status, parse_retry_after(response.headers))
                 
 
+@cached("imageVector", vectorize_cache_version, encode=encode_vector, decode=decode_vector)
+@rate_limited("computerVision")
+async def get_picture_embedding_from_bytes(image_bytes:bytes) ->  List[float]:
+    logging.info(f"Getting picture embedding for downloaded image ({len(image_bytes)} bytes)")
+
+    url = endpoint + "computervision/retrieval:vectorizeImage?api-version=2024-02-01&model-version=2023-04-15"
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "Ocp-Apim-Subscription-Key": key
+    }
+
+    session = get_http_session()
+    async with session.post(url, headers=headers, data=image_bytes) as response:
+        if response.status == 200:
+            data = await response.json()
+            return data['vector']
+        else:
+            error_text = await response.text()
+            logging.error(f"Error getting picture embedding: {response.status} - {error_text}")
+            raise ServiceStatusError(f"Error getting picture embedding: {response.status} - {error_text}",
+                                     response.status, parse_retry_after(response.headers))
+
+
+@cached("cvTextVector", vectorize_cache_version, encode=encode_vector, decode=decode_vector)
+@rate_limited("computerVision")
 async def get_text_embedding_by_computer_vision(text:str)->  List[float]:
     logging.info(f"Getting text embedding for {text}")
     
@@ -49,20 +82,27 @@ async def get_text_embedding_by_computer_vision(text:str)->  List[float]:
         "text": text
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=body) as response:
-            if response.status == 200:
-                data = await response.json()
-                return data['vector']
-            else:
-                error_text = await response.text()
-                logging.error(f"Error getting picture embedding: {response.status} - {error_text}")
-                raise Exception(f"Error getting text embedding: {response.status} - {error_text}")
+    session = get_http_session()
+    async with session.post(url, headers=headers, json=body) as response:
+        if response.status == 200:
+            data = await response.json()
+            return data['vector']
+        else:
+            error_text = await response.text()
+            logging.error(f"Error getting picture embedding: {response.status} - {error_text}")
+            raise ServiceStatusError(f"Error getting text embedding: {response.status} - {error_text}",
+                                     response.status, parse_retry_after(response.headers))
+
+async def _main():
+    try:
+        textEmbeddingResult = await get_text_embedding_by_computer_vision("hello world!")
+        print("textEmbeddingResult: {}",textEmbeddingResult)
+
+        pictureEmbeddingResult = await get_picture_embedding("https://img2.tapimg.com/moment/etag/lhZEbeJKeI5qOwQxlRSUTsZcYen0.png")
+        print("pictureEmbeddingResult: {}",pictureEmbeddingResult)
+    finally:
+        await close_clients()
 
 if __name__ == "__main__":
     # 示例调用
-    textEmbeddingResult = asyncio.run(get_text_embedding_by_computer_vision("hello world!"))
-    print("textEmbeddingResult: {}",textEmbeddingResult)
-
-    pictureEmbeddingResult = asyncio.run(get_picture_embedding("https://img2.tapimg.com/moment/etag/lhZEbeJKeI5qOwQxlRSUTsZcYen0.png"))
-    print("pictureEmbeddingResult: {}",pictureEmbeddingResult)
\ No newline at end of file
+    asyncio.run(_main())
\ No newline at end of file
@@ -1,10 +1,20 @@
 import asyncio
+import base64
+import json
 import logging
 import os
+import weakref
+from typing import List, Union
 
 from dotenv import load_dotenv
 from openai import AsyncAzureOpenAI
 
+from enrichmentCache import cached, version_of
+from microBatcher import MicroBatcher
+from pictureFormatProcess import guess_image_mime_type
+from rateLimiter import rate_limited
+from serviceClients import close_clients, get_client, get_httpx_client
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 load_dotenv(verbose=True)
@@ -14,25 +24,72 @@ api_key= os.getenv("AZURE_OPENAI_API_KEY")
 deployment_name = 'gpt-4o'
 api_version = '2024-02-15-preview' # this might change in the future
 
-aAzureOpenclient =  AsyncAzureOpenAI(
+system_prompt = "You are a helpful assistant and you are a good video player. You know teh video games very well. You can give professional description about video game's screenshot for query or understanding the game."
+describe_prompt = "Describe this picture in Chinese.Do not say something like: The image appears to be a screenshot from a mobile game featuring a colorful and lively campsite. Here are some elements visible in the picture:\n\n1. **Background and Setting:**\n. Directly output the valid and useful information."
+batch_describe_prompt = "Describe each of the following {count} pictures in Chinese, independently of each other. Each picture is preceded by its index. Do not say something like: The image appears to be a screenshot from a mobile game featuring a colorful and lively campsite. Here are some elements visible in the picture. Directly output the valid and useful information. Answer with a JSON object of the form {{\"descriptions\": {{\"0\": \"...\", \"1\": \"...\"}}}} with one entry per picture index."
+
+# changes whenever the model or any prompt changes, invalidating cached descriptions
+content_cache_version = version_of(deployment_name, api_version, system_prompt, describe_prompt, batch_describe_prompt)
+
+# several pictures per chat completion when above 1; the service accepts at most 10 images per request
+multi_model_batch_size = min(int(os.getenv("MULTI_MODEL_BATCH_SIZE", "1")), 10)
+multi_model_batch_max_bytes = int(os.getenv("MULTI_MODEL_BATCH_MAX_BYTES", str(15 * 1024 * 1024)))
+multi_model_batch_max_delay = float(os.getenv("MULTI_MODEL_BATCH_MAX_DELAY_MS", "200")) / 1000
+multi_model_batch_max_concurrency = int(os.getenv("MULTI_MODEL_BATCH_MAX_CONCURRENCY", "4"))
+
+# one batcher per event loop, futures can't cross loops
+_describe_batchers = weakref.WeakKeyDictionary()
+
+# tokens counted against the TPM quota per picture: a high-detail image
+# prompt plus max_tokens, which Azure OpenAI reserves up front
+estimated_picture_tokens = 765 + 500
+
+def _estimate_request_tokens(picture_count:int)->int:
+    return picture_count * estimated_picture_tokens
+
+def get_multi_model_client() -> AsyncAzureOpenAI:
+    return get_client("gpt4o", lambda: AsyncAzureOpenAI(
         api_key=api_key,  
         api_version=api_version,
-        base_url=f"{api_base}/openai/deployments/{deployment_name}"
-    )
+        base_url=f"{api_base}/openai/deployments/{deployment_name}",
+        http_client=get_httpx_client(),
+        max_retries=0  # retries and throttling are handled by rate_limited
+    ))
 
 
+@cached("content", content_cache_version)
 async def get_content_by_mulit_model(picture_url:str)->str:
     logging.info(f"Getting content by muliti model of picture url: {picture_url}")
 
-    response = await aAzureOpenclient.chat.completions.create(
+    return await _describe(picture_url)
+
+@cached("content", content_cache_version)
+async def get_content_by_mulit_model_from_bytes(image_bytes:bytes)->str:
+    logging.info(f"Getting content by muliti model of downloaded picture ({len(image_bytes)} bytes)")
+
+    # base64 is fast C code; sending the image to the process pool and the larger string back costs more
+    return await _describe(to_data_url(image_bytes))
+
+def to_data_url(image_bytes:bytes)->str:
+    mime_type = guess_image_mime_type(image_bytes)
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode()}"
+
+async def _describe(picture_url:str)->str:
+    if multi_model_batch_size > 1:
+        return await get_describe_batcher().submit(picture_url)
+    return await _describe_picture(picture_url)
+
+@rate_limited("gpt4o", weigh=lambda picture_url: _estimate_request_tokens(1))
+async def _describe_picture(picture_url:str)->str:
+    response = await get_multi_model_client().chat.completions.create(
         model=deployment_name,
         seed=99,
         messages=[
-            { "role": "system", "content": "You are a helpful assistant and you are a good video player. You know teh video games very well. You can give professional description about video game's screenshot for query or understanding the game." },
+            { "role": "system", "content": system_prompt },
             { "role": "user", "content": [  
                 { 
                     "type": "text", 
-                    "text": "Describe this picture in Chinese.Do not say something like: The image appears to be a screenshot from a mobile game featuring a colorful and lively campsite. Here are some elements visible in the picture:\n\n1. **Background and Setting:**\n. Directly output the valid and useful information." 
+                    "text": describe_prompt 
                 },
                 { 
                     "type": "image_url",
@@ -47,10 +104,91 @@ async def get_content_by_mulit_model(picture_url:str)->str:
 
     return response.choices[0].message.content
 
+async def describe_pictures_batch(picture_urls:List[str])->List[Union[str, Exception]]:
+    """Describe several pictures with one chat completion.
+
+    The model answers with JSON keyed by picture index; any picture missing
+    from a valid answer is described again on its own.
+    """
+    logging.info(f"Getting content by muliti model for a batch of {len(picture_urls)} pictures")
+
+    user_content = [{ "type": "text", "text": batch_describe_prompt.format(count=len(picture_urls)) }]
+    for index, picture_url in enumerate(picture_urls):
+        user_content.append({ "type": "text", "text": f"Picture {index}:" })
+        user_content.append({ "type": "image_url", "image_url": { "url": picture_url } })
+
+    descriptions = {}
+    try:
+        answer = await _describe_pictures_request(user_content, len(picture_urls))
+        descriptions = _parse_batch_descriptions(answer, len(picture_urls))
+    except Exception as e:
+        logging.warning(f"Batched description failed, falling back to single pictures: {e}")
+
+    missing = [index for index in range(len(picture_urls)) if index not in descriptions]
+    if missing:
+        logging.info(f"Describing {len(missing)} pictures missing from the batch answer one by one")
+        singles = await asyncio.gather(*(_describe_picture(picture_urls[index]) for index in missing),
+                                       return_exceptions=True)
+        descriptions.update(zip(missing, singles))
+    return [descriptions[index] for index in range(len(picture_urls))]
+
+@rate_limited("gpt4o", weigh=lambda user_content, count: _estimate_request_tokens(count))
+async def _describe_pictures_request(user_content:list, count:int)->str:
+    response = await get_multi_model_client().chat.completions.create(
+        model=deployment_name,
+        seed=99,
+        messages=[
+            { "role": "system", "content": system_prompt },
+            { "role": "user", "content": user_content }
+        ],
+        response_format={ "type": "json_object" },
+        max_tokens=500 * count
+    )
+    return response.choices[0].message.content
+
+def _parse_batch_descriptions(answer:str, count:int)->dict:
+    # keep only well-formed, in-range, non-empty entries
+    try:
+        parsed = json.loads(answer or "")
+    except json.JSONDecodeError:
+        logging.warning("Batched description answer is not valid JSON")
+        return {}
+    if isinstance(parsed, dict) and isinstance(parsed.get("descriptions"), dict):
+        parsed = parsed["descriptions"]
+    if not isinstance(parsed, dict):
+        return {}
+
+    descriptions = {}
+    for key, value in parsed.items():
+        try:
+            index = int(key)
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < count and isinstance(value, str) and value.strip():
+            descriptions[index] = value
+    return descriptions
+
+def get_describe_batcher() -> MicroBatcher:
+    loop = asyncio.get_running_loop()
+    batcher = _describe_batchers.get(loop)
+    if batcher is None:
+        batcher = MicroBatcher(describe_pictures_batch,
+                               max_batch_size=multi_model_batch_size,
+                               max_batch_weight=multi_model_batch_max_bytes,
+                               weigh=len,
+                               max_delay=multi_model_batch_max_delay,
+                               max_concurrent_batches=multi_model_batch_max_concurrency)
+        _describe_batchers[loop] = batcher
+    return batcher
 
 
+async def _main():
+    try:
+        contentByMulitModel = await get_content_by_mulit_model("https://img2.tapimg.com/moment/etag/lhZEbeJKeI5qOwQxlRSUTsZcYen0.png")
+        print("contentByMulitModel: {}",contentByMulitModel)
+    finally:
+        await close_clients()
 
 if __name__ == "__main__":
     # 示例调用
-    contentByMulitModel = asyncio.run(get_content_by_mulit_model("https://img2.tapimg.com/moment/etag/lhZEbeJKeI5qOwQxlRSUTsZcYen0.png"))
-    print("contentByMulitModel: {}",contentByMulitModel)
\ No newline at end of file
+    asyncio.run(_main())
\ No newline at end of file
@@ -1,18 +1,48 @@
-from dataclasses import dataclass
-from typing import List
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Tuple, Union
 
+vector_fields = ("captionVector", "contentVector", "ocrContentVecotor", "imageVecotor")
 
-@dataclass
+
+def to_float32(values: Optional[Iterable[float]]) -> Optional[array]:
+    # 4 bytes per value instead of a 24-byte float object plus an 8-byte list slot
+    if values is None or (isinstance(values, array) and values.typecode == "f"):
+        return values
+    # float32 views of a memory-mapped staging file are kept without copying
+    if isinstance(values, memoryview) and values.format == "f":
+        return values
+    return array("f", values)
+
+
+@dataclass(slots=True)
 class Document:
     id: str
     imageUrl: str
     caption: str
     content: str
     ocrContent: str
-    captionVector: List[float]
-    contentVector: List[float]
-    ocrContentVecotor: List[float]
-    imageVecotor: List[float]
+    captionVector: Optional[array]
+    contentVector: Optional[array]
+    ocrContentVecotor: Optional[array]
+    imageVecotor: Optional[array]
+    # set on chunk documents, the id of the image document they belong to
+    parentId: Optional[str] = None
+    # set on partial documents: the only fields to merge into the indexed document
+    updatedFields: Optional[Tuple[str, ...]] = None
+    # set on documents to remove from the index, e.g. OCR chunks beyond a new, shorter chunking
+    deleted: bool = False
+
+    def __post_init__(self):
+        # vectors arrive as float lists from the services and are kept as float32 arrays
+        self.captionVector = to_float32(self.captionVector)
+        self.contentVector = to_float32(self.contentVector)
+        self.ocrContentVecotor = to_float32(self.ocrContentVecotor)
+        self.imageVecotor = to_float32(self.imageVecotor)
+
+
+# the fields stored in the index
+document_fields = tuple(name for name in Document.__dataclass_fields__ if name not in ("updatedFields", "deleted"))
 
 @dataclass
 class ImageData:
@@ -20,8 +50,37 @@ class ImageData:
     imageUrl: str
     caption: str
 
+# a post without an image
+@dataclass
+class TextData:
+    id: str
+    title: str
+    content: str
+
+# an image file on the local disk; its id is the hash of its bytes, set once it is read
+@dataclass
+class LocalImageData:
+    path: str
+    caption: str
+    id: Optional[str] = None
+
 @dataclass
 class RecordResult:
     documentList: List[Document]
-    failedImageList: List[ImageData]
-    totalRecords: int
\ No newline at end of file
+    failedImageList: List[Union[ImageData, TextData, LocalImageData]]
+    totalRecords: int
+    # "file:line: reason" for every line that could not be read as a record
+    malformedLines: List[str] = field(default_factory=list)
+
+@dataclass
+class OcrLine:
+    text: str
+    boundingPolygon: List[Tuple[int, int]]
+    confidence: float
+
+@dataclass
+class ImageAnalysis:
+    captionByCV: str
+    readLines: List[OcrLine] = field(default_factory=list)
+    width: int = 0
+    height: int = 0
@@ -0,0 +1,109 @@
+"""Chooses between the Image Analysis READ text and a Document Intelligence layout pass."""
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from objectDefinition import ImageAnalysis, OcrLine
+from pictureFormatProcess import download_image_bytes
+from pictureOcrProcess import analyze_image_bytes
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# "auto" escalates to Document Intelligence only when layout matters,
+# "read" always uses the READ lines, "layout" always calls Document Intelligence
+ocr_strategy = os.getenv("OCR_STRATEGY", "auto")
+ocr_layout_min_lines = int(os.getenv("OCR_LAYOUT_MIN_LINES", "30"))
+ocr_layout_min_table_rows = int(os.getenv("OCR_LAYOUT_MIN_TABLE_ROWS", "3"))
+ocr_min_read_confidence = float(os.getenv("OCR_MIN_READ_CONFIDENCE", "0.8"))
+
+
+def read_lines_to_text(lines: List[OcrLine]) -> str:
+    return "\n".join(line.text for line in lines)
+
+
+def _count_table_rows(analysis: ImageAnalysis) -> int:
+    # a row is a band of lines sharing a vertical position; three or more
+    # side-by-side lines in one band look like table cells
+    if not analysis.readLines:
+        return 0
+    tolerance = max(4, analysis.height * 0.01) if analysis.height else 8
+
+    centers = []
+    for line in analysis.readLines:
+        if not line.boundingPolygon:
+            continue
+        ys = [y for _, y in line.boundingPolygon]
+        centers.append((min(ys) + max(ys)) / 2)
+    centers.sort()
+
+    table_rows = 0
+    band_size = 0
+    band_start: Optional[float] = None
+    for center in centers:
+        if band_start is not None and center - band_start <= tolerance:
+            band_size += 1
+            continue
+        if band_size >= 3:
+            table_rows += 1
+        band_start, band_size = center, 1
+    if band_size >= 3:
+        table_rows += 1
+    return table_rows
+
+
+def needs_layout_analysis(analysis: ImageAnalysis) -> Tuple[bool, str]:
+    lines = analysis.readLines
+    if not lines:
+        return False, "no text"
+    if len(lines) >= ocr_layout_min_lines:
+        return True, f"{len(lines)} text lines"
+    mean_confidence = sum(line.confidence for line in lines) / len(lines)
+    if mean_confidence < ocr_min_read_confidence:
+        return True, f"READ confidence {mean_confidence:.2f}"
+    table_rows = _count_table_rows(analysis)
+    if table_rows >= ocr_layout_min_table_rows:
+        return True, f"{table_rows} table-like rows"
+    return False, "READ text is sufficient"
+
+
+async def get_ocr_content(analysis: ImageAnalysis,
+                          image_bytes: Optional[bytes] = None,
+                          image_url: Optional[str] = None,
+                          strategy: Optional[str] = None,
+                          run_layout: Optional[Callable[[Awaitable[str]], Awaitable[str]]] = None) -> str:
+    """Return OCR text for an image, reusing the READ result unless layout matters.
+
+    ``image_bytes`` (or ``image_url`` to download them) is only needed when
+    the strategy escalates to Document Intelligence. ``run_layout`` wraps that
+    call only, e.g. to take a Document Intelligence concurrency slot.
+    """
+    strategy = strategy or ocr_strategy
+    if strategy == "read":
+        return read_lines_to_text(analysis.readLines)
+    if strategy == "auto":
+        escalate, reason = needs_layout_analysis(analysis)
+        if not escalate:
+            logging.info(f"Using READ text for OCR: {reason}")
+            return read_lines_to_text(analysis.readLines)
+        logging.info(f"Escalating OCR to Document Intelligence: {reason}")
+    elif strategy != "layout":
+        raise ValueError(f"Unknown OCR strategy: {strategy}")
+
+    if image_bytes is None:
+        image_bytes = await download_image_bytes(image_url)
+    if run_layout is None:
+        return await analyze_image_bytes(image_bytes)
+    return await run_layout(analyze_image_bytes(image_bytes))
+
+
+if __name__ == "__main__":
+    # 示例调用
+    sample = ImageAnalysis(captionByCV="a screenshot",
+                           readLines=[OcrLine(text="Lv.55", boundingPolygon=[(0, 0), (40, 0), (40, 12), (0, 12)], confidence=0.98)])
+    print(needs_layout_analysis(sample))
+    print(asyncio.run(get_ocr_content(sample)))
@@ -1,26 +1,238 @@
 import asyncio
+import hashlib
+import json
 import logging
+import math
 import os
+from dataclasses import dataclass, replace
 from io import BytesIO
+from typing import Dict, List, Optional, Tuple
 
 import httpx
-from PIL import Image
+from dotenv import load_dotenv
+from PIL import Image, ImageOps
+
+from cpuOffload import run_cpu_bound
+from serviceClients import close_clients, get_httpx_client
+
+load_dotenv(verbose=True)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# retries for slow or rate-limiting image CDNs
+download_max_retries = int(os.getenv("DOWNLOAD_MAX_RETRIES", "4"))
+download_backoff_seconds = float(os.getenv("DOWNLOAD_BACKOFF_SECONDS", "1"))
+download_timeout_seconds = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "30"))
+
+_retryable_status = {408, 429, 500, 502, 503, 504}
+
+# shrink each image to what the receiving service actually uses before sending it
+image_normalize_enabled = os.getenv("IMAGE_NORMALIZE_ENABLED", "true").lower() == "true"
+# bumped whenever normalization changes the pixels it produces (2: EXIF orientation applied)
+image_normalize_version = "2"
+# JSON overrides per target, e.g. {"gpt4o": {"max_long_side": 1024, "format": "webp"}}
+image_targets_json = os.getenv("IMAGE_TARGETS")
+
+
+@dataclass
+class ImageTarget:
+    """Size and encoding an image is normalized to for one service.
+
+    ``format`` is ``jpeg``, ``webp`` or ``png``; metadata is never copied.
+    """
+    max_long_side: int
+    max_short_side: Optional[int] = None
+    format: str = "jpeg"
+    quality: int = 85
+
+
+@dataclass
+class NormalizationSavings:
+    images: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+
+
+# GPT-4o tiles high-detail images at 2048 long / 768 short side, larger is wasted upload;
+# READ and Document Intelligence need resolution for small text, the vectorizer very little
+default_image_targets: Dict[str, ImageTarget] = {
+    "gpt4o": ImageTarget(max_long_side=2048, max_short_side=768, format="jpeg", quality=85),
+    "imageAnalysis": ImageTarget(max_long_side=3000, format="jpeg", quality=90),
+    "vectorize": ImageTarget(max_long_side=512, format="jpeg", quality=85),
+    "documentIntelligence": ImageTarget(max_long_side=4000, format="jpeg", quality=92),
+}
+
+normalization_savings: Dict[str, NormalizationSavings] = {}
+
+_image_signatures = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+]
+
+
+def guess_image_mime_type(image_bytes: bytes) -> str:
+    for signature, mime_type in _image_signatures:
+        if image_bytes.startswith(signature):
+            return mime_type
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def download_image_bytes(image_url: str) -> bytes:
+    logging.info(f"Downloading image bytes from {image_url}")
+
+    client = get_httpx_client()
+    for attempt in range(download_max_retries + 1):
+        delay = download_backoff_seconds * (2 ** attempt)
+        try:
+            response = await client.get(image_url, timeout=download_timeout_seconds)
+            if response.status_code not in _retryable_status or attempt == download_max_retries:
+                response.raise_for_status()  # 如果请求失败，则引发异常
+                return response.content
+            delay = _retry_after_seconds(response) or delay
+            logging.warning(f"Download of {image_url} returned {response.status_code}, retrying in {delay}s")
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            if attempt == download_max_retries:
+                raise
+            logging.warning(f"Download of {image_url} failed ({e!r}), retrying in {delay}s")
+        await asyncio.sleep(delay)
 
 async def download_image(image_url: str) -> Image.Image:
     logging.info(f"Downloading image from {image_url}")
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(image_url)
-        response.raise_for_status()  # 如果请求失败，则引发异常
-        image = Image.open(BytesIO(response.content))
-        return image
+    image_bytes = await download_image_bytes(image_url)
+    image = await run_cpu_bound(decode_image, image_bytes, size=len(image_bytes))
+    return image
+
+_exif_orientation = 0x0112
+
+def decode_image(image_bytes: bytes) -> Image.Image:
+    # load eagerly so the pixels are decoded in the pool, not on first use
+    image = Image.open(BytesIO(image_bytes))
+    image.load()
+    return image
+
+def load_image_targets() -> Dict[str, ImageTarget]:
+    targets = dict(default_image_targets)
+    for name, values in (json.loads(image_targets_json) if image_targets_json else {}).items():
+        targets[name] = replace(targets[name], **values) if name in targets else ImageTarget(**values)
+    return targets
+
+image_targets = load_image_targets()
+
+def gpt4o_image_tokens(width: int, height: int) -> int:
+    # high detail: fit into 2048x2048, shorten the short side to 768, then 170 tokens per 512px tile
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def _target_size(width: int, height: int, target: ImageTarget) -> Tuple[int, int]:
+    scale = min(1.0, target.max_long_side / max(width, height))
+    if target.max_short_side:
+        scale = min(scale, target.max_short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def _encode_for_target(image: Image.Image, target: ImageTarget) -> bytes:
+    if target.format == "jpeg" and image.mode != "RGB":
+        # JPEG has no alpha, flatten transparent screenshots onto white
+        rgba = image.convert("RGBA")
+        flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+        flattened.paste(rgba, mask=rgba.getchannel("A"))
+        image = flattened
+    elif target.format == "webp" and image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    output = BytesIO()
+    if target.format == "png":
+        image.save(output, format="PNG", optimize=True)
+    else:
+        image.save(output, format=target.format.upper(), quality=target.quality)
+    return output.getvalue()
+
+def normalize_image_variants(image_bytes: bytes,
+                             targets: Dict[str, ImageTarget]) -> Dict[str, Tuple[bytes, Tuple[int, int], Tuple[int, int]]]:
+    """Decode ``image_bytes`` once and produce one re-encoded variant per target.
+
+    Returns ``(bytes, original size, new size)`` per target name. The image is
+    first turned upright from its EXIF orientation, since re-encoding drops
+    the tag. When no rotation or resize is needed and re-encoding would not
+    shrink the image, the original bytes are kept.
+    """
+    image = decode_image(image_bytes)
+    rotated = image.getexif().get(_exif_orientation, 1) != 1
+    if rotated:
+        image = ImageOps.exif_transpose(image)
+    original_size = image.size
+    variants = {}
+    for name, target in targets.items():
+        size = _target_size(*original_size, target)
+        resized = image.resize(size, Image.LANCZOS) if size != original_size else image
+        encoded = _encode_for_target(resized, target)
+        if not rotated and size == original_size and len(encoded) >= len(image_bytes):
+            encoded = image_bytes
+        variants[name] = (encoded, original_size, size)
+    return variants
+
+async def normalize_image_for_services(image_bytes: bytes,
+                                       targets: Optional[Dict[str, ImageTarget]] = None) -> Dict[str, bytes]:
+    """Return the image bytes to send to each service, normalized in the CPU pool.
+
+    Images that cannot be decoded, or all images when normalization is
+    disabled, are passed through unchanged.
+    """
+    targets = targets or image_targets
+    if not image_normalize_enabled:
+        return {name: image_bytes for name in targets}
+    try:
+        variants = await run_cpu_bound(normalize_image_variants, image_bytes, targets, size=len(image_bytes))
+    except Exception as e:
+        logging.warning(f"Could not normalize image ({len(image_bytes)} bytes), sending it unchanged: {e}")
+        return {name: image_bytes for name in targets}
+
+    for name, (data, original_size, size) in variants.items():
+        savings = normalization_savings.setdefault(name, NormalizationSavings())
+        savings.images += 1
+        savings.bytes_before += len(image_bytes)
+        savings.bytes_after += len(data)
+        if name == "gpt4o":
+            savings.tokens_before += gpt4o_image_tokens(*original_size)
+            savings.tokens_after += gpt4o_image_tokens(*size)
+    return {name: data for name, (data, _, _) in variants.items()}
+
+def log_normalization_savings():
+    for name, savings in normalization_savings.items():
+        if not savings.images:
+            continue
+        saved = 1 - savings.bytes_after / savings.bytes_before if savings.bytes_before else 0
+        message = (f"Image normalization for {name}: {savings.images} images, "
+                   f"{savings.bytes_before / 1e6:.1f} MB -> {savings.bytes_after / 1e6:.1f} MB ({saved:.0%} saved)")
+        if savings.tokens_before:
+            message += f", image tokens {savings.tokens_before} -> {savings.tokens_after}"
+        logging.info(message)
 
 async def save_image_as_pdf(image: Image.Image, pdf_path: str):
     logging.info(f"Saving image as PDF to {pdf_path}")
 
+    await run_cpu_bound(_write_image_pdf, image, pdf_path)
+
+def _write_image_pdf(image: Image.Image, pdf_path: str):
     pdf_bytes = BytesIO()
     image.save(pdf_bytes, format="PDF")
     pdf_bytes.seek(0)
@@ -29,6 +241,50 @@ async def save_image_as_pdf(image: Image.Image, pdf_path: str):
     with open(pdf_path, "wb") as pdf_file:
         pdf_file.write(pdf_bytes.getvalue())
 
+def _pdf_ready(image: Image.Image) -> Image.Image:
+    # the PDF encoder has no alpha or palette support
+    if image.mode not in ("RGB", "L", "CMYK"):
+        return image.convert("RGB")
+    return image
+
+def image_bytes_to_pdf(image_bytes: bytes) -> bytes:
+    # encode in memory, nothing touches the disk
+    pdf_bytes = BytesIO()
+    _pdf_ready(Image.open(BytesIO(image_bytes))).save(pdf_bytes, format="PDF")
+    return pdf_bytes.getvalue()
+
+def images_to_multipage_pdf(images: List[bytes]) -> Tuple[Optional[bytes], List[Optional[Exception]]]:
+    """Pack ``images`` into one PDF, one page each.
+
+    Returns the PDF (``None`` if no image could be decoded) and a per-image
+    list holding the decode error, or ``None`` for images that became a page.
+    """
+    pages = []
+    errors: List[Optional[Exception]] = []
+    for image_bytes in images:
+        try:
+            image = Image.open(BytesIO(image_bytes))
+            image.load()
+            pages.append(_pdf_ready(image))
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    if not pages:
+        return None, errors
+
+    pdf_bytes = BytesIO()
+    pages[0].save(pdf_bytes, format="PDF", save_all=True, append_images=pages[1:])
+    return pdf_bytes.getvalue(), errors
+
+def save_debug_pdf(pdf_bytes: bytes, pdf_dir: str) -> str:
+    # content-addressed name so different images never overwrite each other
+    pdf_path = os.path.join(pdf_dir, hashlib.sha1(pdf_bytes).hexdigest() + ".pdf")
+    os.makedirs(pdf_dir, exist_ok=True)
+    with open(pdf_path, "wb") as pdf_file:
+        pdf_file.write(pdf_bytes)
+    logging.info(f"Saved debug PDF to {pdf_path}")
+    return pdf_path
+
 async def download_and_save_as_pdf(image_url: str, pdf_dir: str) -> str:
     logging.info(f"Downloading image from {image_url} and saving as PDF to {pdf_dir}")
 
@@ -39,9 +295,15 @@ async def download_and_save_as_pdf(image_url: str, pdf_dir: str) -> str:
     await save_image_as_pdf(image, pdf_path)
     return pdf_path
 
+async def _main():
+    try:
+        image_url = "https://img2.tapimg.com/moment/etag/FqoXHRQGKEuYj-ViJ-FTcPXHkRbs.png"
+        pdf_dir = "docs/pdf"
+        result = await download_and_save_as_pdf(image_url, pdf_dir)
+        print("pdf file path: ", result)
+    finally:
+        await close_clients()
+
 if __name__ == "__main__":
     # 示例调用
-    image_url = "https://img2.tapimg.com/moment/etag/FqoXHRQGKEuYj-ViJ-FTcPXHkRbs.png"
-    pdf_dir = "docs/pdf"
-    result = asyncio.run(download_and_save_as_pdf(image_url, pdf_dir))
-    print("pdf file path: ", result)
\ No newline at end of file
+    asyncio.run(_main())
\ No newline at end of file
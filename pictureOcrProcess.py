@@ -3,6 +3,9 @@ import asyncio
 import base64
 import logging
 import os
+import weakref
+from dataclasses import asdict
+from typing import List, Union
 
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import (
@@ -15,6 +18,19 @@ from azure.ai.vision.imageanalysis.models import VisualFeatures
 from azure.core.credentials import AzureKeyCredential
 from dotenv import load_dotenv
 
+from cpuOffload import run_cpu_bound
+from enrichmentCache import cached, decode_json, encode_json, version_of
+from microBatcher import MicroBatcher
+from objectDefinition import ImageAnalysis, OcrLine
+from pictureFormatProcess import (
+    guess_image_mime_type,
+    image_bytes_to_pdf,
+    images_to_multipage_pdf,
+    save_debug_pdf,
+)
+from rateLimiter import rate_limited
+from serviceClients import close_clients, get_azure_transport, get_client
+
 load_dotenv(verbose=True)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,21 +41,143 @@ key = os.getenv("FORM_RECOGNIZER_KEY")
 cvEndpoint = os.getenv("AZURE_COMPUTER_VISION_ENDPOINT")
 cvEndpointKey = os.getenv("AZURE_COMPUTER_VISION_KEY")
 
+# when set, every document sent to OCR is also written here for debugging
+ocr_debug_pdf_dir = os.getenv("OCR_DEBUG_PDF_DIR")
+
+# image formats prebuilt-layout accepts as-is, anything else goes through an in-memory PDF
+_ocr_native_mime_types = {"image/jpeg", "image/png", "image/bmp", "image/tiff"}
+
+# multi-page batching: more than one page packs several images into one analyze call
+ocr_batch_max_pages = int(os.getenv("OCR_BATCH_MAX_PAGES", "1"))
+ocr_batch_max_bytes = int(os.getenv("OCR_BATCH_MAX_BYTES", str(50 * 1024 * 1024)))
+ocr_batch_max_delay = float(os.getenv("OCR_BATCH_MAX_DELAY_MS", "500")) / 1000
+ocr_batch_max_concurrency = int(os.getenv("OCR_BATCH_MAX_CONCURRENCY", "4"))
+
+layout_cache_version = version_of("prebuilt-layout", ContentFormat.MARKDOWN)
+image_analysis_cache_version = version_of("caption,read,denseCaptions", "gender_neutral_caption=False")
 
+# one batcher per event loop, futures can't cross loops
+_ocr_batchers = weakref.WeakKeyDictionary()
+
+
+def get_document_intelligence_client() -> DocumentIntelligenceClient:
+    return get_client("documentIntelligence", lambda: DocumentIntelligenceClient(
+        endpoint=endpoint, credential=AzureKeyCredential(key), transport=get_azure_transport(),
+        retry_total=0))  # retries and throttling are handled by rate_limited
+
+def get_image_analysis_client() -> ImageAnalysisClient:
+    return get_client("imageAnalysis", lambda: ImageAnalysisClient(
+        endpoint=cvEndpoint, credential=AzureKeyCredential(cvEndpointKey), transport=get_azure_transport(),
+        retry_total=0))
+
+@rate_limited("documentIntelligence")
 async def analyze_document(document_path: str):
     logging.info(f"Analyzing document {document_path}")
 
-    async with DocumentIntelligenceClient(endpoint=endpoint, credential=AzureKeyCredential(key)) as document_analysis_client:
-        poller = await document_analysis_client.begin_analyze_document(
-                "prebuilt-layout", 
-                AnalyzeDocumentRequest(bytes_source= await convert_pdf_to_base64(document_path)),
-                output_content_format=ContentFormat.MARKDOWN
-            )
-        result: AnalyzeResult  = await poller.result()
-        return result.content
+    document_analysis_client = get_document_intelligence_client()
+    poller = await document_analysis_client.begin_analyze_document(
+            "prebuilt-layout", 
+            AnalyzeDocumentRequest(bytes_source= await convert_pdf_to_base64(document_path)),
+            output_content_format=ContentFormat.MARKDOWN
+        )
+    result: AnalyzeResult  = await poller.result()
+    return result.content
+
+@rate_limited("documentIntelligence")
+async def _analyze_layout(document_bytes: bytes) -> AnalyzeResult:
+    document_analysis_client = get_document_intelligence_client()
+    poller = await document_analysis_client.begin_analyze_document(
+            "prebuilt-layout", 
+            document_bytes,
+            content_type="application/octet-stream",
+            output_content_format=ContentFormat.MARKDOWN
+        )
+    return await poller.result()
+
+@cached("layoutOcr", layout_cache_version)
+async def analyze_document_bytes(document_bytes: bytes) -> str:
+    logging.info(f"Analyzing in-memory document ({len(document_bytes)} bytes)")
+
+    result = await _analyze_layout(document_bytes)
+    return result.content
+
+@cached("layoutOcr", layout_cache_version)
+async def analyze_image_bytes(image_bytes: bytes) -> str:
+    if ocr_batch_max_pages > 1:
+        return await get_ocr_batcher().submit(image_bytes)
+    return await analyze_single_image_bytes(image_bytes)
+
+async def analyze_single_image_bytes(image_bytes: bytes) -> str:
+    logging.info(f"Analyzing downloaded image ({len(image_bytes)} bytes)")
+
+    if guess_image_mime_type(image_bytes) in _ocr_native_mime_types and not ocr_debug_pdf_dir:
+        return await analyze_document_bytes(image_bytes)
+
+    pdf_bytes = await run_cpu_bound(image_bytes_to_pdf, image_bytes, size=len(image_bytes))
+    if ocr_debug_pdf_dir:
+        save_debug_pdf(pdf_bytes, ocr_debug_pdf_dir)
+    return await analyze_document_bytes(pdf_bytes)
+
+async def analyze_images_batch(images: List[bytes]) -> List[Union[str, Exception]]:
+    """OCR several images with one multi-page analyze call.
+
+    Returns the markdown of each image's page, or the exception for images
+    that could not be decoded or whose page is missing from the result.
+    If the batch call itself fails, each image is retried on its own.
+    """
+    logging.info(f"Analyzing a batch of {len(images)} images as one document")
+
+    pdf_bytes, errors = await run_cpu_bound(images_to_multipage_pdf, images, size=sum(len(image) for image in images))
+    outcomes: List[Union[str, Exception]] = list(errors)
+    if pdf_bytes is None:
+        return outcomes
+    if ocr_debug_pdf_dir:
+        save_debug_pdf(pdf_bytes, ocr_debug_pdf_dir)
+
+    try:
+        result = await _analyze_layout(pdf_bytes)
+    except Exception as e:
+        logging.warning(f"Batched OCR failed, falling back to single images: {e}")
+        singles = await asyncio.gather(*(analyze_single_image_bytes(image) for image, error in zip(images, errors) if error is None),
+                                       return_exceptions=True)
+        singles = iter(singles)
+        return [error if error is not None else next(singles) for error in errors]
+
+    # page n of the PDF belongs to the n-th image that decoded
+    page_contents = {}
+    for page in result.pages or []:
+        page_contents[page.page_number] = "".join(result.content[span.offset:span.offset + span.length]
+                                                  for span in page.spans or [])
+    page_number = 0
+    for index, error in enumerate(errors):
+        if error is not None:
+            continue
+        page_number += 1
+        if page_number in page_contents:
+            outcomes[index] = page_contents[page_number]
+        else:
+            outcomes[index] = Exception(f"Page {page_number} missing from batched OCR result")
+    return outcomes
+
+def get_ocr_batcher() -> MicroBatcher:
+    loop = asyncio.get_running_loop()
+    batcher = _ocr_batchers.get(loop)
+    if batcher is None:
+        batcher = MicroBatcher(analyze_images_batch,
+                               max_batch_size=ocr_batch_max_pages,
+                               max_batch_weight=ocr_batch_max_bytes,
+                               weigh=len,
+                               max_delay=ocr_batch_max_delay,
+                               max_concurrent_batches=ocr_batch_max_concurrency)
+        _ocr_batchers[loop] = batcher
+    return batcher
 
 async def convert_pdf_to_base64(pdf_path: str):
     logging.info(f"Converting PDF to base64: {pdf_path}")
+    # a file read and a fast C encode: a thread, not the process pool, which would copy the string back
+    return await asyncio.to_thread(_read_base64, pdf_path)
+
+def _read_base64(pdf_path: str) -> str:
     # Read the PDF file in binary mode, encode it to base64, and decode to string
     with open(pdf_path, "rb") as file:
         base64_encoded_pdf = base64.b64encode(file.read()).decode()
@@ -48,14 +186,63 @@ async def convert_pdf_to_base64(pdf_path: str):
 
 async def get_image_caption_byCV(image_url: str) -> str:
 
+    return (await analyze_image_byCV(image_url)).captionByCV
+
+async def get_image_caption_byCV_from_bytes(image_bytes: bytes) -> str:
+
+    return (await analyze_image_byCV_from_bytes(image_bytes)).captionByCV
+
+def _encode_image_analysis(analysis: ImageAnalysis) -> bytes:
+    return encode_json(asdict(analysis))
+
+def _decode_image_analysis(value: bytes) -> ImageAnalysis:
+    data = decode_json(value)
+    data["readLines"] = [OcrLine(text=line["text"],
+                                 boundingPolygon=[tuple(point) for point in line["boundingPolygon"]],
+                                 confidence=line["confidence"])
+                         for line in data["readLines"]]
+    return ImageAnalysis(**data)
+
+@cached("imageAnalysis", image_analysis_cache_version, encode=_encode_image_analysis, decode=_decode_image_analysis)
+@rate_limited("computerVision")
+async def analyze_image_byCV(image_url: str) -> ImageAnalysis:
+
     logging.info(f"Getting caption of image {image_url}")
-    async with ImageAnalysisClient(endpoint=cvEndpoint, credential=AzureKeyCredential(cvEndpointKey)) as imageAnalysisClient:
-        result = await imageAnalysisClient.analyze_from_url(
-            image_url=image_url,
-            visual_features=[VisualFeatures.CAPTION, VisualFeatures.READ, VisualFeatures.DENSE_CAPTIONS],
-            gender_neutral_caption=False
-        )
-        
+    result = await get_image_analysis_client().analyze_from_url(
+        image_url=image_url,
+        visual_features=[VisualFeatures.CAPTION, VisualFeatures.READ, VisualFeatures.DENSE_CAPTIONS],
+        gender_neutral_caption=False
+    )
+    return _to_image_analysis(result)
+
+@cached("imageAnalysis", image_analysis_cache_version, encode=_encode_image_analysis, decode=_decode_image_analysis)
+@rate_limited("computerVision")
+async def analyze_image_byCV_from_bytes(image_bytes: bytes) -> ImageAnalysis:
+
+    logging.info(f"Getting caption of downloaded image ({len(image_bytes)} bytes)")
+    result = await get_image_analysis_client().analyze(
+        image_data=image_bytes,
+        visual_features=[VisualFeatures.CAPTION, VisualFeatures.READ, VisualFeatures.DENSE_CAPTIONS],
+        gender_neutral_caption=False
+    )
+    return _to_image_analysis(result)
+
+def _to_image_analysis(result) -> ImageAnalysis:
+    # keep the READ lines instead of discarding them, OCR can often use them directly
+    read_lines = []
+    if result.read is not None:
+        for block in result.read.blocks:
+            for line in block.lines:
+                confidences = [word.confidence for word in line.words]
+                read_lines.append(OcrLine(text=line.text,
+                                          boundingPolygon=[(point.x, point.y) for point in line.bounding_polygon],
+                                          confidence=sum(confidences) / len(confidences) if confidences else 0.0))
+    return ImageAnalysis(captionByCV=_combine_dense_captions(result),
+                         readLines=read_lines,
+                         width=result.metadata.width if result.metadata else 0,
+                         height=result.metadata.height if result.metadata else 0)
+
+def _combine_dense_captions(result) -> str:
     if result.dense_captions["values"] is not None:
         values_list = result.dense_captions["values"]
         combined_text = ''.join(item['text'] for item in values_list)
@@ -64,13 +251,19 @@ async def get_image_caption_byCV(image_url: str) -> str:
     else:
         return ""
 
+async def _main():
+    try:
+        # document_path = "docs/pdf/lnXUR7aSAmIIRZsSITN9BFxmou0f.pdf"
+        # result = await analyze_document(document_path)
+        # print("picture's ocr content: {}",result)
+
+        image_url="https://img2.tapimg.com/moment/etag/FqoXHRQGKEuYj-ViJ-FTcPXHkRbs.png"
+        caption = await get_image_caption_byCV(image_url)
+        print("image caption: {}",caption)
+    finally:
+        await close_clients()
+
 if __name__ == "__main__":
     # 示例调用
-    # document_path = "docs/pdf/lnXUR7aSAmIIRZsSITN9BFxmou0f.pdf"
-    # result = asyncio.run(analyze_document(document_path))
-    # print("picture's ocr content: {}",result)
-
-    image_url="https://img2.tapimg.com/moment/etag/FqoXHRQGKEuYj-ViJ-FTcPXHkRbs.png"
-    caption = asyncio.run(get_image_caption_byCV(image_url))
-    print("image caption: {}",caption)
+    asyncio.run(_main())
 
@@ -1,12 +1,12 @@
 import argparse
 import asyncio
-import dataclasses
+import json
 import os
 import time
+from array import array
 
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureDeveloperCliCredential
-from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     AIServicesVisionParameters,
@@ -35,7 +35,25 @@ from tqdm import tqdm
 # 加载 .env 文件中的环境变量
 load_dotenv()
 
-from data_utils import process_images_records
+from cpuOffload import shutdown_cpu_executor
+from data_utils import default_download_once, stream_images_records
+from indexUploader import IndexUploader
+from ingestionEngine import default_max_in_flight, parse_service_limits
+from ingestionJournal import STATUS_UNCHANGED, IngestionJournal, default_journal_path
+from localImages import shutdown_read_executor
+from objectDefinition import RecordResult, document_fields, vector_fields
+from serviceClients import close_clients
+from stagingStore import StagingReader, StagingWriter, default_staging_dir
+
+default_data_file = "multi-models/image_captions/ima_files_2_test.txt"
+# documents waiting for upload; enrichment pauses when the queue is full
+upload_queue_size = int(os.getenv("UPLOAD_QUEUE_SIZE", "200"))
+# upload a partial batch after this many seconds without new documents
+upload_flush_seconds = float(os.getenv("UPLOAD_FLUSH_SECONDS", "5"))
+# only re-enrich and re-upload the fields that changed since the last upload
+default_incremental = os.getenv("INGEST_INCREMENTAL", "true").lower() == "true"
+# failed or unfinished records of the last run, one JSON object per line
+default_failure_report = os.getenv("INGEST_FAILURE_REPORT", "failed_records.jsonl")
 
 
 def create_search_index(index_name, index_client):
@@ -61,6 +79,7 @@ def create_search_index(index_name, index_client):
                 SearchableField(name="content", type=SearchFieldDataType.String, analyzer_name="zh-Hans.microsoft"),# context of the picture from gpt-4o
                 SimpleField(name="imageUrl", type=SearchFieldDataType.String,Searchable=False,filterable=False, sortable=True, facetable=True),# url of the picture
                 SearchableField(name="ocrContent", type=SearchFieldDataType.String,analyzer_name="zh-Hans.microsoft"), # context of the picture from document intelligence
+                SimpleField(name="parentId", type=SearchFieldDataType.String, filterable=True), # image id of an OCR chunk document, empty on image documents
                 SearchField(name="captionVector", 
                             type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
                             hidden=False, 
@@ -147,49 +166,104 @@ def create_search_index(index_name, index_client):
         )
         print(f"Creating {index_name} search index")
         index_client.create_index(index)
+        return True
     else:
         print(f"Search index {index_name} already exists")
+        return False
 
 
-def upload_documents_to_index(docs, search_client, upload_batch_size=50):
-    to_upload_dicts = []
-
-    for document in docs:
-        d = dataclasses.asdict(document)
-        # add id to documents
-        d.update({"@search.action": "upload", "id": str(d["id"])})
-
-        if "captionVector" in d and d["captionVector"] is None:
-            del d["captionVector"]
-        if "contentVector" in d and d["contentVector"] is None:
-            del d["contentVector"]
-        if "ocrContentVecotor" in d and d["ocrContentVecotor"] is None:
-            del d["ocrContentVecotor"]
-        if "imageVecotor" in d and d["imageVecotor"] is None:
-            del d["imageVecotor"]
-
-        to_upload_dicts.append(d)
-
-    # Upload the documents in batches of upload_batch_size
-    for i in tqdm(
-        range(0, len(to_upload_dicts), upload_batch_size), desc="Indexing Chunks..."
-    ):
-        batch = to_upload_dicts[i : i + upload_batch_size]
-        results = search_client.upload_documents(documents=batch)
-        num_failures = 0
-        errors = set()
-        for result in results:
-            if not result.succeeded:
-                print(
-                    f"Indexing Failed for {result.key} with ERROR: {result.error_message}"
-                )
-                num_failures += 1
-                errors.add(result.error_message)
-        if num_failures > 0:
-            raise Exception(
-                f"INDEXING FAILED for {num_failures} documents. Please recreate the index."
-                f"To Debug: PLEASE CHECK chunk_size and upload_batch_size. \n Error Messages: {list(errors)}"
-            )
+# left out when None; image documents have no parentId, so indexes created before chunking keep working
+_omitted_when_none = set(vector_fields) | {"parentId"}
+# 9 significant digits round-trip any float32
+_float32_text = "{:.9g}".format
+
+
+def _upload_action(document):
+    if document.deleted:
+        return "delete", ("id",)
+    # a partial document only carries the fields that changed, merged into the indexed one
+    if document.updatedFields is None:
+        return "upload", document_fields
+    return "mergeOrUpload", ("id",) + document.updatedFields
+
+
+def document_to_upload_json(document) -> bytes:
+    """Upload JSON of ``document``, vectors written straight from their float32 arrays or views."""
+    action, names = _upload_action(document)
+    parts = [f'"@search.action":"{action}"']
+    for name in names:
+        value = getattr(document, name)
+        if value is None and name in _omitted_when_none:
+            continue
+        if isinstance(value, (array, memoryview)):
+            parts.append(f'"{name}":[{",".join(map(_float32_text, value))}]')
+        else:
+            parts.append(f'"{name}":{json.dumps(str(value) if name == "id" else value, ensure_ascii=False)}')
+    return ("{" + ",".join(parts) + "}").encode("utf-8")
+
+
+async def stream_documents_to_index(documents, uploader: IndexUploader,
+                                    queue_size=upload_queue_size, flush_seconds=upload_flush_seconds,
+                                    journal=None):
+    """Upload documents from an async iterator while they are still being produced.
+
+    A bounded queue sits between enrichment and upload, so enrichment pauses
+    when uploads fall behind; ``uploader`` sends several batches at once. A
+    partial batch is flushed once its oldest document has waited
+    ``flush_seconds``, even while new documents keep arriving.
+    Returns the number uploaded. Uploaded (or failed) keys are recorded in
+    ``journal`` when given; failed keys no longer stop the run.
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    end_of_stream = object()
+
+    async def produce():
+        try:
+            async for document in documents:
+                await queue.put(document)
+        finally:
+            await queue.put(end_of_stream)
+
+    progress = tqdm(desc="Indexing Chunks...", unit="doc")
+
+    def uploaded(keys):
+        if journal is not None:
+            journal.mark_uploaded(keys)
+        progress.update(len(keys))
+
+    def failed(key, error):
+        if journal is not None:
+            journal.mark_failed(key, Exception(error), stage="upload")
+
+    uploader.on_uploaded = uploaded
+    uploader.on_failed = failed
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            if uploader.oldest_pending is None:
+                item = await queue.get()
+            else:
+                # the first documents become searchable within flush_seconds, however steadily more arrive
+                wait = uploader.oldest_pending + flush_seconds - time.monotonic()
+                try:
+                    if wait <= 0:
+                        raise asyncio.TimeoutError
+                    item = await asyncio.wait_for(queue.get(), timeout=wait)
+                except asyncio.TimeoutError:
+                    await uploader.flush()
+                    continue
+            if item is end_of_stream:
+                break
+            await uploader.add_serialized(str(item.id), document_to_upload_json(item))
+
+        await uploader.close()
+        # surface enrichment errors that ended the stream
+        await producer
+    finally:
+        producer.cancel()
+        progress.close()
+    return uploader.uploaded
 
 
 def validate_index(index_name, index_client):
@@ -208,24 +282,64 @@ def validate_index(index_name, index_client):
             break
 
 
-async def create_and_populate_index(index_name:str, index_client:SearchIndexClient,search_client:SearchClient):
-    # create or update search index with compatible schema
-    create_search_index(index_name, index_client)
+async def create_and_populate_index(index_name:str, index_client:SearchIndexClient, uploader:IndexUploader,
+                                    data_file:str=default_data_file,
+                                    max_in_flight:int=default_max_in_flight, service_limits=None, ordered:bool=True,
+                                    download_once:bool=default_download_once,
+                                    resume:bool=False, journal_path:str=None,
+                                    failure_report:str=default_failure_report,
+                                    staging_dir:str=default_staging_dir,
+                                    incremental:bool=default_incremental):
+    # create or update search index with compatible schema; a new index gets every document
+    if create_search_index(index_name, index_client):
+        incremental = False
+    # staging has to hold every document for --fromstaging, a run that skips unchanged records would leave only the delta
+    if staging_dir and incremental:
+        print(f"Staging to {staging_dir}: enriching every record, incremental updates are off for this run")
+        incremental = False
 
-    # process records
-    # print("insert data...")
-    recordResult = await process_images_records(file_path= "multi-models/image_captions/ima_files_2_test.txt")
+    # the journal checkpoints every record, a fresh run starts from an empty one
+    journal = IngestionJournal(journal_path or default_journal_path(index_name))
+    if not resume:
+        journal.reset()
 
-    if len(recordResult.documentList) == 0:
+    # enrich records and upload them as they complete
+    print("Enriching records and uploading documents to index...")
+    recordResult = RecordResult(documentList=[], failedImageList=[], totalRecords=0)
+    # a resumed run adds to the documents staged before the interruption
+    staging = StagingWriter(staging_dir, append=resume) if staging_dir else None
+    try:
+        documents = stream_images_records(file_path=data_file,
+                                          recordResult=recordResult,
+                                          max_in_flight=max_in_flight,
+                                          service_limits=service_limits,
+                                          ordered=ordered,
+                                          download_once=download_once,
+                                          journal=journal,
+                                          resume=resume,
+                                          staging=staging,
+                                          incremental=incremental)
+        uploaded = await stream_documents_to_index(documents, uploader, journal=journal)
+    finally:
+        await close_clients()
+        shutdown_cpu_executor()
+        shutdown_read_executor()
+        if staging is not None:
+            staging.close()
+        failed = journal.write_failure_report(failure_report)
+        counts = journal.counts()
+        journal.close()
+
+    if uploaded == 0 and not (resume and counts.get("uploaded")) and not counts.get(STATUS_UNCHANGED):
         raise Exception("No records found. Please check the data path and records.")
 
     print(f"Processed {recordResult.totalRecords} records")
-    print(f"records with errors: {len(recordResult.failedImageList)} records")
-    print(f"valid records: {len(recordResult.documentList)} documents")
-
-    # upload documents to index
-    print("Uploading documents to index...")
-    upload_documents_to_index(recordResult.documentList, search_client)
+    print(f"records with errors: {failed} records, see {failure_report}")
+    if recordResult.malformedLines:
+        print(f"malformed lines: {len(recordResult.malformedLines)} lines skipped, e.g. {recordResult.malformedLines[0]}")
+    print(f"valid records: {uploaded} documents uploaded in this run, {counts.get('uploaded', 0)} in total")
+    if incremental:
+        print(f"unchanged records: {counts.get(STATUS_UNCHANGED, 0)} records skipped")
 
     # check if index is ready/validate index
     print("Validating index...")
@@ -233,6 +347,31 @@ async def create_and_populate_index(index_name:str, index_client:SearchIndexClie
     print("Index validation completed")
 
 
+async def index_from_staging(index_name:str, index_client:SearchIndexClient, uploader:IndexUploader,
+                             staging_dir:str):
+    """Index the documents staged by an earlier run, without calling any enrichment service."""
+    create_search_index(index_name, index_client)
+
+    reader = StagingReader(staging_dir)
+    print(f"Uploading {len(reader)} staged documents from {staging_dir} to index...")
+
+    async def staged_documents():
+        for document in reader:
+            yield document
+
+    try:
+        uploaded = await stream_documents_to_index(staged_documents(), uploader)
+    finally:
+        await close_clients()
+        reader.close()
+
+    print(f"valid records: {uploaded} documents uploaded, {len(uploader.failed)} failed")
+
+    print("Validating index...")
+    validate_index(index_name, index_client)
+    print("Index validation completed")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Prepare documents by extracting content from PDFs, splitting content into sections and indexing in a search index.",
@@ -261,6 +400,70 @@ if __name__ == "__main__":
         help="Optional. Use this Azure Cognitive Search account key instead of the current user identity to login (use az login to set current user for Azure)",
     )
 
+    parser.add_argument(
+        "--datafile",
+        default=default_data_file,
+        help="Optional. Record file with one record per line (dict, JSONL or CSV), or a directory or glob of local images, e.g. \"docs/images/*.JPG\"",
+    )
+    parser.add_argument(
+        "--maxinflight",
+        type=int,
+        default=default_max_in_flight,
+        help="Optional. Maximum number of records enriched at the same time",
+    )
+    parser.add_argument(
+        "--servicelimits",
+        required=False,
+        default=None,
+        help="Optional. Per-service in-flight limits, e.g. gpt4o=4,documentIntelligence=8 (defaults to INGEST_SERVICE_LIMITS)",
+    )
+    parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="Optional. Collect documents in completion order instead of input order",
+    )
+
+    parser.add_argument(
+        "--remotefetch",
+        action="store_true",
+        help="Optional. Let every service fetch the image URL itself instead of downloading each image once",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Optional. Continue an interrupted run, skipping records the journal marks as uploaded and retrying the rest",
+    )
+    parser.add_argument(
+        "--journal",
+        required=False,
+        default=None,
+        help="Optional. Checkpoint journal file (defaults to .cache/ingest-journal-<index>.sqlite)",
+    )
+    parser.add_argument(
+        "--failurereport",
+        default=default_failure_report,
+        help="Optional. File receiving one JSON line per failed or unfinished record",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Optional. Re-enrich and re-upload every record, even those unchanged since the last upload",
+    )
+    parser.add_argument(
+        "--staging",
+        required=False,
+        default=default_staging_dir,
+        help="Optional. Directory where enriched documents are also staged, so they can be indexed again without enrichment; every record is enriched, as with --full (defaults to STAGING_DIR)",
+    )
+    parser.add_argument(
+        "--fromstaging",
+        required=False,
+        default=None,
+        help="Optional. Skip enrichment and index the documents staged in this directory by an earlier run",
+    )
+
     args = parser.parse_args()
 
     # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
@@ -279,9 +482,21 @@ if __name__ == "__main__":
     search_endpoint = f"https://{args.searchservice}.search.windows.net/"
     index_client = SearchIndexClient(endpoint=search_endpoint, credential=search_creds)
 
-    search_client = SearchClient(
-        endpoint=search_endpoint, credential=search_creds, index_name=args.index
-    )
+    uploader = IndexUploader(search_endpoint, args.index, search_creds)
 
-    asyncio.run(create_and_populate_index(args.index, index_client,search_client))
+    if args.fromstaging:
+        asyncio.run(index_from_staging(args.index, index_client, uploader, args.fromstaging))
+    else:
+        service_limits = parse_service_limits(args.servicelimits) if args.servicelimits else None
+        asyncio.run(create_and_populate_index(args.index, index_client, uploader,
+                                              data_file=args.datafile,
+                                              max_in_flight=args.maxinflight,
+                                              service_limits=service_limits,
+                                              ordered=not args.unordered,
+                                              download_once=default_download_once and not args.remotefetch,
+                                              resume=args.resume,
+                                              journal_path=args.journal,
+                                              failure_report=args.failurereport,
+                                              staging_dir=args.staging,
+                                              incremental=default_incremental and not args.full))
     print("Data preparation for index", args.index, "completed")
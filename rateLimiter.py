@@ -0,0 +1,318 @@
+"""Adaptive, quota-aware pacing and retries for calls to the Azure services.
+
+Every service endpoint gets one ``AdaptiveLimiter`` per event loop. It spaces
+requests with token buckets for the request and token quotas, waits out
+``Retry-After`` when the service throttles, and adapts its concurrency limit
+additively up on success and multiplicatively down on throttling (AIMD).
+Each attempt is bounded by the policy timeout, each call by its deadline,
+and slow attempts can be hedged with a duplicate request.
+"""
+import asyncio
+import email.utils
+import functools
+import logging
+import random
+import time
+import weakref
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+
+import aiohttp
+import httpx
+from dotenv import load_dotenv
+
+from ingestionEngine import percentile
+from servicePolicy import ServicePolicy, get_service_policy
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+_throttle_status = {429, 503}
+_transient_status = {408, 500, 502, 504}
+
+# one set of limiters per event loop, their locks can't cross loops
+_loop_limiters = weakref.WeakKeyDictionary()
+
+
+class ServiceStatusError(Exception):
+    """An unsuccessful HTTP status from a service called without an SDK."""
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """A call, retries included, ran past the deadline of its service policy."""
+
+    def __init__(self, message: str, service: str, deadline_seconds: float):
+        super().__init__(message)
+        self.service = service
+        self.deadline_seconds = deadline_seconds
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Seconds to wait from ``retry-after-ms``, ``x-ms-retry-after-ms`` or ``Retry-After``."""
+    if not headers:
+        return None
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error: BaseException) -> Tuple[bool, bool, Optional[float]]:
+    """Return (retryable, throttled, retry_after) for an exception raised by a service call."""
+    # the deadline already covers every retry
+    if isinstance(error, DeadlineExceededError):
+        return False, False, None
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, httpx.TransportError)):
+        return True, False, None
+    # openai.APIStatusError and azure HttpResponseError both carry status_code and response
+    status = getattr(error, "status_code", None)
+    if status is None:
+        # openai.APIConnectionError and APITimeoutError
+        return type(error).__name__ in ("APIConnectionError", "APITimeoutError"), False, None
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        response = getattr(error, "response", None)
+        retry_after = parse_retry_after(getattr(response, "headers", None))
+    if status in _throttle_status:
+        return True, True, retry_after
+    return status in _transient_status, False, retry_after
+
+
+class TokenBucket:
+    """Refills ``per_minute`` units evenly, holding at most ``burst_seconds`` worth."""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1.0):
+        # a request larger than the bucket waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter:
+    def __init__(self, service: str, policy: ServicePolicy):
+        self.service = service
+        self.policy = policy
+        self.limit = float(policy.max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # recent successful attempt latencies per wrapped function
+        self._latencies: Dict[str, deque] = {}
+        self._condition = asyncio.Condition()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._requests = TokenBucket(policy.requests_per_minute, policy.burst_seconds) if policy.requests_per_minute else None
+        self._tokens = TokenBucket(policy.tokens_per_minute, policy.burst_seconds) if policy.tokens_per_minute else None
+
+    async def _acquire(self, tokens: float):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+        if self._requests is not None:
+            await self._requests.acquire(1)
+        if self._tokens is not None and tokens:
+            await self._tokens.acquire(tokens)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def _release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _on_success(self):
+        # additive increase: about one more slot per full window of successes
+        self.limit = min(float(self.policy.max_concurrency), self.limit + 1 / self.limit)
+
+    def _on_throttle(self, retry_after: Optional[float], delay: float):
+        self.throttled += 1
+        now = time.monotonic()
+        # one burst of 429s should halve the limit once, not once per request
+        if now - self._last_decrease > delay:
+            self.limit = max(float(self.policy.min_concurrency), self.limit / 2)
+            self._last_decrease = now
+        self._paused_until = max(self._paused_until, now + delay)
+        logging.warning(f"{self.service} throttled, concurrency limit now {int(self.limit)}, "
+                        f"pausing {delay:.1f}s" + (" (Retry-After)" if retry_after is not None else ""))
+
+    def hedge_delay(self, name: str) -> Optional[float]:
+        """Seconds after which an attempt of ``name`` is hedged, ``None`` when hedging is off."""
+        samples = self._latencies.get(name)
+        if self.policy.hedge_percentile is None or not samples or len(samples) < self.policy.hedge_min_samples:
+            return None
+        return percentile(samples, self.policy.hedge_percentile)
+
+    async def _attempt(self, func: Callable[..., Awaitable[Any]], args, kwargs, tokens: float) -> Any:
+        await self._acquire(tokens)
+        started = time.monotonic()
+        try:
+            if self.policy.timeout_seconds:
+                result = await asyncio.wait_for(func(*args, **kwargs), self.policy.timeout_seconds)
+            else:
+                result = await func(*args, **kwargs)
+        finally:
+            await self._release()
+        samples = self._latencies.setdefault(func.__qualname__, deque(maxlen=self.policy.latency_window))
+        samples.append(time.monotonic() - started)
+        return result
+
+    async def _hedged_attempt(self, func: Callable[..., Awaitable[Any]], args, kwargs, tokens: float) -> Any:
+        delay = self.hedge_delay(func.__qualname__)
+        if delay is None:
+            return await self._attempt(func, args, kwargs, tokens)
+
+        primary = asyncio.create_task(self._attempt(func, args, kwargs, tokens))
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self.hedges += 1
+                logging.info(f"{self.service} call slower than {delay:.1f}s, sending a hedged request")
+                pending.add(asyncio.create_task(self._attempt(func, args, kwargs, tokens)))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # the losing request is cancelled, which also releases its slot
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _call(self, func: Callable[..., Awaitable[Any]], args, kwargs, tokens: float) -> Any:
+        attempt = 0
+        while True:
+            try:
+                result = await self._hedged_attempt(func, args, kwargs, tokens)
+            except Exception as e:
+                retryable, throttled, retry_after = classify_error(e)
+                if not retryable or attempt >= self.policy.max_retries:
+                    raise
+                backoff = min(self.policy.max_backoff_seconds, self.policy.backoff_seconds * (2 ** attempt))
+                delay = retry_after if retry_after is not None else backoff * random.uniform(0.5, 1.0)
+                self.retries += 1
+                attempt += 1
+                if throttled:
+                    # the pause applies to every caller of this endpoint
+                    self._on_throttle(retry_after, delay)
+                else:
+                    logging.warning(f"{self.service} call failed ({e!r}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                continue
+            self._on_success()
+            return result
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, tokens: float = 0, **kwargs) -> Any:
+        if self.policy.deadline_seconds:
+            try:
+                async with asyncio.timeout(self.policy.deadline_seconds) as deadline:
+                    return await self._call(func, args, kwargs, tokens)
+            except asyncio.TimeoutError:
+                # an attempt that timed out on its last retry is not a missed deadline
+                if not deadline.expired():
+                    raise
+                raise DeadlineExceededError(f"{self.service} call {func.__qualname__} exceeded its "
+                                            f"{self.policy.deadline_seconds}s deadline",
+                                            self.service, self.policy.deadline_seconds)
+        return await self._call(func, args, kwargs, tokens)
+
+
+def get_rate_limiter(service: str) -> AdaptiveLimiter:
+    loop = asyncio.get_running_loop()
+    limiters: Dict[str, AdaptiveLimiter] = _loop_limiters.setdefault(loop, {})
+    limiter = limiters.get(service)
+    if limiter is None:
+        limiter = AdaptiveLimiter(service, get_service_policy(service))
+        limiters[service] = limiter
+    return limiter
+
+
+def rate_limited(service: str, weigh: Optional[Callable[..., float]] = None):
+    """Pace and retry an async service call through the limiter of ``service``.
+
+    ``weigh`` receives the call's arguments and returns its estimated token
+    cost, counted against the service's tokens-per-minute quota.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            tokens = weigh(*args, **kwargs) if weigh is not None else 0
+            return await get_rate_limiter(service).call(func, *args, tokens=tokens, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == "__main__":
+    # 示例调用
+    async def _main():
+        calls = []
+
+        @rate_limited("example")
+        async def flaky():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise ServiceStatusError("busy", 429, retry_after=0.2)
+            return len(calls)
+
+        print(await flaky(), get_rate_limiter("example").limit)
+
+        @rate_limited("example")
+        async def sometimes_slow(i):
+            # one attempt in ten hits a slow backend
+            await asyncio.sleep(1.0 if random.random() < 0.1 else 0.01)
+            return i
+
+        limiter = get_rate_limiter("example")
+        limiter.policy.hedge_percentile = 90
+        started = time.monotonic()
+        for i in range(40):
+            await sometimes_slow(i)
+        print(f"{time.monotonic() - started:.2f}s, hedges {limiter.hedges}, hedge wins {limiter.hedge_wins}")
+
+    asyncio.run(_main())
@@ -0,0 +1,113 @@
+"""Lazy readers for record files: Python dict per line, JSON Lines and CSV.
+
+Every source yields ``(line_number, fields)`` pairs one record at a time.
+A line that can't be parsed is logged with its line number, kept in
+``malformed`` and skipped; it never stops the file.
+"""
+import ast
+import csv
+import json
+import logging
+import mmap
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# "dict", "jsonl" or "csv"; guessed from the file extension when not set
+record_format = os.getenv("RECORD_FORMAT")
+# files at least this large are memory-mapped instead of read through a buffer
+record_mmap_min_bytes = int(float(os.getenv("RECORD_MMAP_MIN_MB", "64")) * 1024 * 1024)
+
+# malformed lines logged one by one; the rest are only counted
+_max_logged_malformed = 20
+_format_by_extension = {".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl", ".csv": "csv"}
+
+
+def parse_dict_line(line: str) -> Dict[str, Any]:
+    """Parse one ``{'key': 'value', ...}`` line as a literal, without evaluating any code."""
+    value = ast.literal_eval(line)
+    if not isinstance(value, dict):
+        raise ValueError(f"expected a dict, got {type(value).__name__}")
+    return value
+
+
+def parse_json_line(line: str) -> Dict[str, Any]:
+    value = json.loads(line)
+    if not isinstance(value, dict):
+        raise ValueError(f"expected a JSON object, got {type(value).__name__}")
+    return value
+
+
+def _iter_lines(file_path: str) -> Iterator[Tuple[int, bytes]]:
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        if size >= record_mmap_min_bytes:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from enumerate(iter(mapped.readline, b""), start=1)
+        else:
+            yield from enumerate(file, start=1)
+
+
+class RecordSource:
+    """Records of one file, read lazily in the given (or guessed) format."""
+
+    def __init__(self, file_path: str, format: Optional[str] = None):
+        self.file_path = file_path
+        self.format = format or record_format or _format_by_extension.get(os.path.splitext(file_path)[1].lower(), "dict")
+        if self.format not in ("dict", "jsonl", "csv"):
+            raise Exception(f"Unknown record format: {self.format}")
+        self.malformed: List[str] = []
+
+    def report(self, line_number: int, reason: str):
+        message = f"{self.file_path}:{line_number}: {reason}"
+        if len(self.malformed) < _max_logged_malformed:
+            logging.warning(f"Skipping malformed record {message}")
+        self.malformed.append(message)
+
+    def _log_summary(self):
+        if len(self.malformed) > _max_logged_malformed:
+            logging.warning(f"Skipped {len(self.malformed)} malformed records in {self.file_path}")
+
+    def __iter__(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        try:
+            yield from self._iter_csv() if self.format == "csv" else self._iter_lines()
+        finally:
+            self._log_summary()
+
+    def _iter_lines(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        parse = parse_json_line if self.format == "jsonl" else parse_dict_line
+        for line_number, line in _iter_lines(self.file_path):
+            try:
+                line = line.decode("utf-8-sig" if line_number == 1 else "utf-8").strip()
+                if not line:
+                    continue
+                fields = parse(line)
+            except (ValueError, SyntaxError, MemoryError, RecursionError) as e:
+                self.report(line_number, f"{type(e).__name__}: {e}")
+                continue
+            yield line_number, fields
+
+    def _iter_csv(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        with open(self.file_path, "r", encoding="utf-8-sig", newline="") as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                if None in row:
+                    self.report(reader.line_num, f"{len(row[None])} values more than the {len(reader.fieldnames)} columns")
+                    continue
+                if any(value is None for value in row.values()):
+                    self.report(reader.line_num, "fewer values than columns")
+                    continue
+                yield reader.line_num, row
+
+
+if __name__ == "__main__":
+    # 示例调用
+    source = RecordSource("multi-models/image_captions/ima_files_2_test.txt")
+    for line_number, fields in source:
+        print(line_number, fields["id"], fields["caption"][:40])
+    print(f"{len(source.malformed)} malformed lines")
@@ -5,16 +5,18 @@ from typing import List
 
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.models import QueryType, VectorizedQuery
 from dotenv import load_dotenv
-from openai import AzureOpenAI
 
 from multiModelsEmbedding import (
     get_picture_embedding,
     get_text_embedding_by_computer_vision,
 )
-from pictureFormatProcess import download_and_save_as_pdf
-from pictureOcrProcess import analyze_document, get_image_caption_byCV
+from ocrStrategy import get_ocr_content
+from pictureOcrProcess import analyze_image_byCV
+from serviceClients import close_clients, close_sync_clients, get_sync_client
+from textEmbeddingProcess import get_text_embedding
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,118 +28,114 @@ azure_search_index_name = os.getenv("AZURE_SEARCH_INDEX")
 azure_search_key = os.getenv("AZURE_COGNITIVE_SEARCH_KEY") 
 azure_search_credential = AzureKeyCredential(azure_search_key)
 
-
-azureOpenAIClient = AzureOpenAI(
-  api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
-  api_version = "2024-02-01",
-  azure_endpoint =os.getenv("AZURE_OPENAI_BASE") 
-)
-
-azure_openAI_embedding_deployment = os.getenv("EMBEDDING_MODEL_DEPLOYMENT")
 azure_computer_vision_endpoint = os.getenv("AZURE_COMPUTER_VISION_ENDPOINT")
 azure_computer_vision_key = os.getenv("AZURE_COMPUTER_VISION_KEY")
-pdf_dir = "docs/pdf"
 
+search_top = 3
+# OCR chunk hits collapse into their image, so more hits are fetched than returned
+search_chunk_overfetch = 4
+search_select_fields = ["id", "caption", "content", "imageUrl", "ocrContent"]
 
-async def get_search_results_by_image(query_image_url:str):
-     # generate ocr content by form recognizer service
-    pdfFileLocalPath =  await download_and_save_as_pdf(query_image_url,pdf_dir)
-    ocrContent = await analyze_document(pdfFileLocalPath)
-    captionByCV = await get_image_caption_byCV(query_image_url)
-
-    query = ocrContent + captionByCV
-    
-    aoaiResponse = azureOpenAIClient.embeddings.create(input = query,model = azure_openAI_embedding_deployment)  
-    aoai_embedding_query = aoaiResponse.data[0].embedding
-    #print(aoai_embedding_query)
+# whether the index has parentId, i.e. may hold OCR chunk documents; looked up once
+_index_has_chunks = None
 
-    cv_embedding_query = await get_picture_embedding(query_image_url)
-    #print(cv_embedding_query)
 
-    search_client = SearchClient(azure_search_service_endpoint, azure_search_index_name, AzureKeyCredential(azure_search_key))
+def get_search_client() -> SearchClient:
+    return get_sync_client("search", lambda: SearchClient(azure_search_service_endpoint, azure_search_index_name, AzureKeyCredential(azure_search_key)))
 
-    aoai_embedding_query = VectorizedQuery(vector=aoai_embedding_query, 
-                                k_nearest_neighbors=3, 
-                                fields="contentVector,captionVector,ocrContentVecotor")
 
-    azure_cv_embedding_query = VectorizedQuery(vector=cv_embedding_query, 
-                                k_nearest_neighbors=3, 
-                                fields="imageVecotor")
+def get_search_index_client() -> SearchIndexClient:
+    return get_sync_client("searchIndex", lambda: SearchIndexClient(azure_search_service_endpoint, AzureKeyCredential(azure_search_key)))
 
-    results = search_client.search(  
-        search_text=query,
-        search_fields=["caption","content","ocrContent"],
-        query_language="zh-cn",
-        scoring_profile="firstProfile",   
-        vector_queries=[aoai_embedding_query,azure_cv_embedding_query],
-        query_type=QueryType.SEMANTIC, 
-        semantic_configuration_name='default', 
-        select=["id","caption", "content","imageUrl","ocrContent"],
-        top=3
-    )
 
-    return results
+def index_has_chunks() -> bool:
+    """Whether the index schema has ``parentId``; indexes built before OCR chunking don't."""
+    global _index_has_chunks
+    if _index_has_chunks is None:
+        fields = get_search_index_client().get_index(azure_search_index_name).fields
+        _index_has_chunks = any(field.name == "parentId" for field in fields)
+    return _index_has_chunks
 
-async def get_search_results_by_text(query_text:str):
-    aoaiResponse = azureOpenAIClient.embeddings.create(input = query_text,model = azure_openAI_embedding_deployment)  
-    aoai_embedding_query = aoaiResponse.data[0].embedding
-    cv_embedding_query = await get_text_embedding_by_computer_vision(query_text)
 
-    search_client = SearchClient(azure_search_service_endpoint, azure_search_index_name, AzureKeyCredential(azure_search_key))
+def collapse_ocr_chunks(results, top: int = search_top) -> list:
+    """One hit per image, in rank order: a hit on an OCR chunk stands for the image it belongs to.
 
-    aoai_embedding_query = VectorizedQuery(vector=aoai_embedding_query, 
-                                k_nearest_neighbors=3, 
+    The fields of such a hit are those of its image document, looked up by
+    ``parentId``; the text of the matching chunk is kept as ``ocrChunk``.
+    """
+    hits, seen = [], set()
+    for result in results:
+        image_id = result.get("parentId") or result["id"]
+        if image_id in seen:
+            continue
+        seen.add(image_id)
+        if result.get("parentId"):
+            image = get_search_client().get_document(key=image_id, selected_fields=search_select_fields)
+            result = {**result, **image, "ocrChunk": result["ocrContent"]}
+        hits.append(result)
+        if len(hits) == top:
+            break
+    return hits
+
+
+def search_images(search_text: str, text_embedding: List[float], cv_embedding: List[float]):
+    # older indexes have no parentId to select and no chunk documents to collapse
+    collapse = index_has_chunks()
+    top = search_top * search_chunk_overfetch if collapse else search_top
+
+    aoai_embedding_query = VectorizedQuery(vector=text_embedding, 
+                                k_nearest_neighbors=top, 
                                 fields="contentVector,captionVector,ocrContentVecotor")
 
-    azure_cv_embedding_query = VectorizedQuery(vector=cv_embedding_query, 
-                                k_nearest_neighbors=3, 
+    azure_cv_embedding_query = VectorizedQuery(vector=cv_embedding, 
+                                k_nearest_neighbors=top, 
                                 fields="imageVecotor")
 
-    results = search_client.search(  
-        search_text=query_text,
+    results = get_search_client().search(  
+        search_text=search_text,
         search_fields=["caption","content","ocrContent"],
         query_language="zh-cn",
         scoring_profile="firstProfile",   
         vector_queries=[aoai_embedding_query,azure_cv_embedding_query],
         query_type=QueryType.SEMANTIC, 
         semantic_configuration_name='default', 
-        select=["id","caption", "content","imageUrl","ocrContent"],
-        top=3
+        select=search_select_fields + (["parentId"] if collapse else []),
+        top=top
     )
 
-    return results
+    return collapse_ocr_chunks(results) if collapse else results
 
-async def get_search_results_by_image_and_text(query_image_url:str,query_text:str):
-    aoaiResponse = azureOpenAIClient.embeddings.create(input = query_text,model = azure_openAI_embedding_deployment)  
-    aoai_embedding_query = aoaiResponse.data[0].embedding
+
+async def get_search_results_by_image(query_image_url:str):
+     # generate ocr content by form recognizer service
+    imageAnalysis = await analyze_image_byCV(query_image_url)
+    ocrContent = await get_ocr_content(imageAnalysis, image_url=query_image_url)
+    captionByCV = imageAnalysis.captionByCV
+
+    query = ocrContent + captionByCV
+    
+    aoai_embedding_query = await get_text_embedding(query)
     #print(aoai_embedding_query)
 
     cv_embedding_query = await get_picture_embedding(query_image_url)
     #print(cv_embedding_query)
 
-    search_client = SearchClient(azure_search_service_endpoint, azure_search_index_name, AzureKeyCredential(azure_search_key))
+    return search_images(query, aoai_embedding_query, cv_embedding_query)
 
-    aoai_embedding_query = VectorizedQuery(vector=aoai_embedding_query, 
-                                k_nearest_neighbors=3, 
-                                fields="contentVector,captionVector,ocrContentVecotor")
+async def get_search_results_by_text(query_text:str):
+    aoai_embedding_query = await get_text_embedding(query_text)
+    cv_embedding_query = await get_text_embedding_by_computer_vision(query_text)
 
-    azure_cv_embedding_query = VectorizedQuery(vector=cv_embedding_query, 
-                                k_nearest_neighbors=3, 
-                                fields="imageVecotor")
+    return search_images(query_text, aoai_embedding_query, cv_embedding_query)
 
-    results = search_client.search(  
-        search_text=query_text,
-        search_fields=["caption","content","ocrContent"],
-        query_language="zh-cn",
-        scoring_profile="firstProfile",   
-        vector_queries=[aoai_embedding_query,azure_cv_embedding_query],
-        query_type=QueryType.SEMANTIC, 
-        semantic_configuration_name='default', 
-        select=["id","caption", "content","imageUrl","ocrContent"],
-        top=3
-    )
+async def get_search_results_by_image_and_text(query_image_url:str,query_text:str):
+    aoai_embedding_query = await get_text_embedding(query_text)
+    #print(aoai_embedding_query)
+
+    cv_embedding_query = await get_picture_embedding(query_image_url)
+    #print(cv_embedding_query)
 
-    return results
+    return search_images(query_text, aoai_embedding_query, cv_embedding_query)
 
 if __name__ == "__main__":
 
@@ -145,16 +143,26 @@ if __name__ == "__main__":
 
     query = "DNF手游伤害为什么是黄字？"
 
-    results = asyncio.run(get_search_results_by_image_and_text(query_image_url,query))
+    async def _main():
+        try:
+            return await get_search_results_by_image_and_text(query_image_url,query)
+        finally:
+            await close_clients()
+
+    results = asyncio.run(_main())
     print("####################Results####################")
     
-    for result in results:
-        print(f"Reranker Score: {result['@search.reranker_score']}")
-        print(f"Score: {result['@search.score']}")  
-        print(f"Captions: {result['@search.captions']}")  
-        print(f"Highlights: {result['@search.highlights']}")  
-        print(f"caption: {result['caption']}\n")  
-        print(f"content: {result['content']}\n")  
-        print(f"ocrContent: {result['ocrContent']}\n")  
-        print(f"imageUrl: {result['imageUrl']}\n")  
-        print("###############################")
+    # the search client pages results lazily, so it is closed once they are read
+    try:
+        for result in results:
+            print(f"Reranker Score: {result['@search.reranker_score']}")
+            print(f"Score: {result['@search.score']}")  
+            print(f"Captions: {result['@search.captions']}")  
+            print(f"Highlights: {result['@search.highlights']}")  
+            print(f"caption: {result['caption']}\n")  
+            print(f"content: {result['content']}\n")  
+            print(f"ocrContent: {result['ocrContent']}\n")  
+            print(f"imageUrl: {result['imageUrl']}\n")  
+            print("###############################")
+    finally:
+        close_sync_clients()
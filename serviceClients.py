@@ -0,0 +1,111 @@
+"""Shared, pooled clients for every service the pipeline talks to.
+
+Async clients hold connections bound to the event loop that created them, so
+they are cached per running loop; sync clients are cached process-wide.
+Call ``close_clients()`` before the loop shuts down to release the pools.
+"""
+import asyncio
+import inspect
+import logging
+import os
+import weakref
+from typing import Any, Callable, Dict
+
+import aiohttp
+import httpx
+from azure.core.pipeline.transport import AioHttpTransport
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# connection pool sizing, shared by every client on a loop
+http_pool_size = int(os.getenv("HTTP_POOL_SIZE", "100"))
+http_pool_size_per_host = int(os.getenv("HTTP_POOL_SIZE_PER_HOST", "32"))
+http_keepalive_seconds = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+http_timeout_seconds = float(os.getenv("HTTP_TIMEOUT_SECONDS", "120"))
+
+_loop_clients = weakref.WeakKeyDictionary()
+_shared_clients: Dict[str, Any] = {}
+
+
+def _clients_for_running_loop() -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.get(loop)
+    if clients is None:
+        clients = {}
+        _loop_clients[loop] = clients
+    return clients
+
+
+def get_client(name: str, factory: Callable[[], Any]) -> Any:
+    """Return the async client registered as ``name`` on the running loop, creating it once."""
+    clients = _clients_for_running_loop()
+    if name not in clients:
+        logging.info(f"Creating shared client {name}")
+        clients[name] = factory()
+    return clients[name]
+
+
+def get_sync_client(name: str, factory: Callable[[], Any]) -> Any:
+    """Return the process-wide sync client registered as ``name``, creating it once."""
+    if name not in _shared_clients:
+        logging.info(f"Creating shared client {name}")
+        _shared_clients[name] = factory()
+    return _shared_clients[name]
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    return get_client("aiohttp", lambda: aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=http_pool_size,
+                                       limit_per_host=http_pool_size_per_host,
+                                       keepalive_timeout=http_keepalive_seconds),
+        timeout=aiohttp.ClientTimeout(total=http_timeout_seconds)))
+
+
+def get_httpx_client() -> httpx.AsyncClient:
+    return get_client("httpx", lambda: httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=http_pool_size,
+                            max_keepalive_connections=http_pool_size_per_host,
+                            keepalive_expiry=http_keepalive_seconds),
+        timeout=http_timeout_seconds,
+        follow_redirects=True))
+
+
+def get_azure_transport() -> AioHttpTransport:
+    # azure-core clients reuse the shared aiohttp pool instead of opening their own
+    return AioHttpTransport(session=get_http_session(), session_owner=False)
+
+
+async def _close(client: Any):
+    for method_name in ("aclose", "close"):
+        method = getattr(client, method_name, None)
+        if method is None:
+            continue
+        result = method()
+        if inspect.isawaitable(result):
+            await result
+        return
+
+
+async def close_clients():
+    """Close every async client created on the running loop, the shared session last."""
+    clients = _loop_clients.pop(asyncio.get_running_loop(), {})
+    session = clients.pop("aiohttp", None)
+    for name, client in clients.items():
+        try:
+            await _close(client)
+        except Exception as e:
+            logging.warning(f"Error closing client {name}: {e}")
+    if session is not None:
+        await session.close()
+
+
+def close_sync_clients():
+    while _shared_clients:
+        name, client = _shared_clients.popitem()
+        try:
+            client.close()
+        except Exception as e:
+            logging.warning(f"Error closing client {name}: {e}")
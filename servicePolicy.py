@@ -0,0 +1,98 @@
+"""Per-service call policy: quotas, concurrency, retries, timeouts and hedging, configured in one place.
+
+Built-in defaults can be overridden with a JSON object keyed by service name,
+either inline in ``SERVICE_POLICIES`` or in the file named by
+``SERVICE_POLICY_FILE``, e.g.
+``{"gpt4o": {"requests_per_minute": 300, "tokens_per_minute": 50000, "hedge_percentile": 95}}``.
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass, fields, replace
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+service_policy_file = os.getenv("SERVICE_POLICY_FILE")
+service_policies_json = os.getenv("SERVICE_POLICIES")
+
+
+@dataclass
+class ServicePolicy:
+    """How calls to one service endpoint are paced, retried and bounded in time.
+
+    Quotas left as ``None`` are not enforced locally; the concurrency limit
+    still adapts to throttling between ``min_concurrency`` and ``max_concurrency``.
+    ``timeout_seconds`` bounds each attempt and ``deadline_seconds`` the whole
+    call including retries. With ``hedge_percentile`` set, a duplicate request
+    is sent once an attempt runs longer than that percentile of recent
+    latencies, and the first answer wins.
+    """
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    # Azure evaluates per-minute quotas over short windows, so bursts are capped too
+    burst_seconds: float = 10.0
+    max_concurrency: int = 16
+    min_concurrency: int = 1
+    max_retries: int = 6
+    backoff_seconds: float = 1.0
+    max_backoff_seconds: float = 60.0
+    timeout_seconds: Optional[float] = None
+    deadline_seconds: Optional[float] = None
+    hedge_percentile: Optional[float] = None
+    # latencies observed before hedging starts, and how many are kept
+    hedge_min_samples: int = 20
+    latency_window: int = 200
+
+
+# Computer Vision S1 allows 10 and Document Intelligence S0 15 requests per second;
+# Azure OpenAI quotas depend on the deployment and should be set in the config
+default_policies: Dict[str, ServicePolicy] = {
+    "gpt4o": ServicePolicy(max_concurrency=8, timeout_seconds=90, deadline_seconds=300),
+    "embedding": ServicePolicy(max_concurrency=16, timeout_seconds=30, deadline_seconds=120),
+    "computerVision": ServicePolicy(requests_per_minute=600, max_concurrency=16,
+                                    timeout_seconds=30, deadline_seconds=120),
+    "documentIntelligence": ServicePolicy(requests_per_minute=900, max_concurrency=8,
+                                          timeout_seconds=120, deadline_seconds=600),
+    "search": ServicePolicy(max_concurrency=8, timeout_seconds=120, deadline_seconds=600),
+}
+
+_policies: Optional[Dict[str, ServicePolicy]] = None
+
+
+def _load_overrides() -> Dict[str, dict]:
+    overrides = {}
+    if service_policy_file:
+        with open(service_policy_file, "r", encoding="utf-8") as file:
+            overrides.update(json.load(file))
+    if service_policies_json:
+        overrides.update(json.loads(service_policies_json))
+    return overrides
+
+
+def load_service_policies(overrides: Optional[Dict[str, dict]] = None) -> Dict[str, ServicePolicy]:
+    known = {f.name for f in fields(ServicePolicy)}
+    policies = dict(default_policies)
+    for service, values in (overrides if overrides is not None else _load_overrides()).items():
+        unknown = set(values) - known
+        if unknown:
+            raise ValueError(f"Unknown policy settings for {service}: {sorted(unknown)}")
+        policies[service] = replace(policies.get(service, ServicePolicy()), **values)
+    return policies
+
+
+def get_service_policy(service: str) -> ServicePolicy:
+    global _policies
+    if _policies is None:
+        _policies = load_service_policies()
+    return _policies.get(service) or ServicePolicy()
+
+
+if __name__ == "__main__":
+    # 示例调用
+    for name, policy in load_service_policies().items():
+        print(name, policy)
@@ -0,0 +1,133 @@
+"""Dependency-graph executor for the per-record enrichment stages."""
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+@dataclass
+class Stage:
+    """One enrichment step.
+
+    ``func`` is called with the results of ``deps`` as positional arguments,
+    in the order they are listed. When an optional stage (``required=False``)
+    fails, ``default`` is used as its result and dependents still run.
+    """
+    name: str
+    func: Callable[..., Awaitable[Any]]
+    deps: List[str] = field(default_factory=list)
+    required: bool = True
+    default: Any = None
+
+
+class StageFailedError(Exception):
+    def __init__(self, stage: str, cause: BaseException):
+        super().__init__(f"Stage {stage} failed: {cause}")
+        self.stage = stage
+        self.cause = cause
+
+
+def _validate(stages: List[Stage]) -> Dict[str, Stage]:
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError(f"Duplicate stage name: {stage.name}")
+        by_name[stage.name] = stage
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+
+    # reject cycles up front instead of deadlocking at runtime
+    visiting, visited = set(), set()
+
+    def visit(name: str):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage graph has a cycle through {name}")
+        visiting.add(name)
+        for dep in by_name[name].deps:
+            visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in by_name:
+        visit(name)
+    return by_name
+
+
+async def run_stage_graph(stages: List[Stage],
+                          on_stage_complete: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Run ``stages`` as soon as their dependencies are ready.
+
+    Returns a dict of stage name to result. If a required stage fails, every
+    stage still running is cancelled and ``StageFailedError`` is raised.
+    ``on_stage_complete`` is called with the name of each stage that succeeds.
+    """
+    by_name = _validate(stages)
+    results: Dict[str, Any] = {}
+    running: Dict[asyncio.Task, Stage] = {}
+    waiting = list(stages)
+
+    try:
+        while waiting or running:
+            for stage in list(waiting):
+                if all(dep in results for dep in stage.deps):
+                    waiting.remove(stage)
+                    args = [results[dep] for dep in stage.deps]
+                    running[asyncio.create_task(stage.func(*args))] = stage
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                stage = running.pop(task)
+                error = task.exception() if not task.cancelled() else asyncio.CancelledError()
+                if error is None:
+                    results[stage.name] = task.result()
+                    if on_stage_complete is not None:
+                        on_stage_complete(stage.name)
+                elif stage.required:
+                    raise StageFailedError(stage.name, error)
+                else:
+                    logging.warning(f"Optional stage {stage.name} failed, using default: {error}")
+                    results[stage.name] = stage.default
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    return {name: results[name] for name in by_name}
+
+
+def select_stages(stages: List[Stage], targets: List[str]) -> List[Stage]:
+    """The stages needed to compute ``targets``: the targets and everything they depend on."""
+    by_name = _validate(stages)
+    needed = set()
+
+    def visit(name: str):
+        if name not in needed:
+            needed.add(name)
+            for dep in by_name[name].deps:
+                visit(dep)
+
+    for name in targets:
+        visit(name)
+    return [stage for stage in stages if stage.name in needed]
+
+
+if __name__ == "__main__":
+    # 示例调用
+    async def _step(value, delay=0.1):
+        await asyncio.sleep(delay)
+        return value
+
+    graph = [
+        Stage("pdf", lambda: _step("pdf")),
+        Stage("ocr", lambda pdf: _step(f"ocr({pdf})"), deps=["pdf"]),
+        Stage("cvCaption", lambda: _step("caption")),
+        Stage("captionVector", lambda caption: _step(f"vector({caption})"), deps=["cvCaption"]),
+    ]
+    print(asyncio.run(run_stage_graph(graph)))
@@ -0,0 +1,236 @@
+"""Columnar on-disk staging of enriched documents between enrichment and indexing.
+
+A staging directory holds one ``<field>.npy`` file per vector field (float32
+rows, readable with ``numpy.load(..., mmap_mode="r")``) and ``documents.jsonl``
+with the text fields of each document and the row of each of its vectors.
+Reading maps the vector files into memory, so documents are streamed back
+without copying or parsing their vectors.
+"""
+import ast
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, Iterator, Optional
+
+from dotenv import load_dotenv
+
+from objectDefinition import Document, document_fields, vector_fields
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# enriched documents are also written here when set
+default_staging_dir = os.getenv("STAGING_DIR") or None
+# the vector headers are rewritten every so many documents, so an interrupted run leaves readable files
+staging_flush_every = int(os.getenv("STAGING_FLUSH_EVERY", "1000"))
+
+documents_file = "documents.jsonl"
+manifest_file = "manifest.json"
+staging_version = 1
+
+_npy_magic = b"\x93NUMPY\x01\x00"
+# the header is rewritten with the final row count, so it gets a fixed size
+_npy_header_size = 128
+_float32_descr = "<f4" if sys.byteorder == "little" else ">f4"
+_text_fields = [name for name in document_fields if name not in vector_fields]
+
+
+def _npy_header(rows: int, dim: int) -> bytes:
+    header = repr({"descr": _float32_descr, "fortran_order": False, "shape": (rows, dim)}).encode("latin1")
+    padding = _npy_header_size - len(_npy_magic) - 2 - len(header) - 1
+    return _npy_magic + struct.pack("<H", _npy_header_size - len(_npy_magic) - 2) + header + b" " * padding + b"\n"
+
+
+def _read_npy_header(data) -> Dict:
+    if bytes(data[:len(_npy_magic)]) != _npy_magic:
+        raise Exception("Not a staging vector file")
+    (length,) = struct.unpack("<H", bytes(data[len(_npy_magic):len(_npy_magic) + 2]))
+    header = ast.literal_eval(bytes(data[len(_npy_magic) + 2:len(_npy_magic) + 2 + length]).decode("latin1"))
+    header["offset"] = len(_npy_magic) + 2 + length
+    return header
+
+
+class _VectorColumnWriter:
+    """Appends float32 rows of one vector field to its ``.npy`` file."""
+
+    def __init__(self, path: str, append: bool):
+        self.path = path
+        self.rows = 0
+        self.dim = None
+        if append and os.path.exists(path):
+            with open(path, "rb") as file:
+                header = _read_npy_header(file.read(_npy_header_size))
+            # a column that never got a vector has no dimension yet
+            self.dim = header["shape"][1] or None
+            # a row cut short by an interrupted run is dropped
+            self.rows = (os.path.getsize(path) - header["offset"]) // (4 * self.dim) if self.dim else 0
+            self.file = open(path, "r+b")
+            self.file.truncate(header["offset"] + self.rows * 4 * (self.dim or 0))
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            self.file.write(_npy_header(0, 0))
+
+    def append(self, vector) -> int:
+        first = self.dim is None
+        if first:
+            self.dim = len(vector)
+        elif len(vector) != self.dim:
+            raise Exception(f"{os.path.basename(self.path)}: vector of {len(vector)} dimensions, expected {self.dim}")
+        self.file.write(vector if isinstance(vector, (array, memoryview)) else array("f", vector))
+        self.rows += 1
+        if first:
+            # the dimension is in the header from the first row on, a resumed run needs it
+            self.flush()
+        return self.rows - 1
+
+    def flush(self):
+        self.file.seek(0)
+        self.file.write(_npy_header(self.rows, self.dim or 0))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class StagingWriter:
+    """Writes enriched documents to a staging directory.
+
+    With ``append`` the documents of an earlier, possibly interrupted, run
+    are kept. A document staged twice (e.g. enriched again after a resume)
+    appears twice; uploading it twice is harmless.
+    """
+
+    def __init__(self, directory: str, append: bool = False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.count = 0
+        documents_path = os.path.join(directory, documents_file)
+        if not append:
+            for name in os.listdir(directory):
+                if name == documents_file or name == manifest_file or name.endswith(".npy"):
+                    os.remove(os.path.join(directory, name))
+        elif os.path.exists(documents_path):
+            self._drop_partial_line(documents_path)
+            with open(documents_path, "rb") as file:
+                self.count = sum(1 for _ in file)
+        self.columns = {name: _VectorColumnWriter(os.path.join(directory, f"{name}.npy"), append)
+                        for name in vector_fields}
+        self.documents = open(documents_path, "a", encoding="utf-8")
+
+    @staticmethod
+    def _drop_partial_line(path: str):
+        with open(path, "r+b") as file:
+            data = file.read()
+            if data and not data.endswith(b"\n"):
+                file.truncate(data.rfind(b"\n") + 1)
+
+    def append(self, document: Document):
+        # vectors go first, so a line never refers to a row that was not written
+        line = {name: getattr(document, name) for name in _text_fields}
+        for name in vector_fields:
+            vector = getattr(document, name)
+            line[name] = None if vector is None else self.columns[name].append(vector)
+        self.documents.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self.count += 1
+        if self.count % staging_flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        # vectors first, for the same reason as in append
+        for column in self.columns.values():
+            column.flush()
+        self.documents.flush()
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+        self.documents.close()
+        with open(os.path.join(self.directory, manifest_file), "w", encoding="utf-8") as file:
+            json.dump({"version": staging_version,
+                       "documents": self.count,
+                       "vectors": {name: {"rows": column.rows, "dim": column.dim}
+                                   for name, column in self.columns.items()}}, file, indent=2)
+        logging.info(f"Staged {self.count} documents in {self.directory}")
+
+
+class _VectorColumn:
+    """Memory-mapped rows of one vector field, returned as float32 memoryviews."""
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _read_npy_header(self.map)
+        if header["descr"] != _float32_descr:
+            raise Exception(f"{path}: expected {_float32_descr} vectors, found {header['descr']}")
+        self.rows, self.dim = header["shape"]
+        self.values = memoryview(self.map)[header["offset"]:header["offset"] + self.rows * self.dim * 4].cast("f")
+
+    def row(self, index: int) -> memoryview:
+        if not 0 <= index < self.rows:
+            raise Exception(f"Vector row {index} out of range, the column has {self.rows} rows")
+        return self.values[index * self.dim:(index + 1) * self.dim]
+
+    def close(self):
+        self.values.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # rows still referenced by documents; the map goes away with them
+            pass
+        self.file.close()
+
+
+class StagingReader:
+    """Streams the documents of a staging directory back, vectors as views of the mapped files."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        manifest_path = os.path.join(directory, manifest_file)
+        if not os.path.exists(manifest_path):
+            raise Exception(f"{directory} has no {manifest_file}, the staging run did not finish")
+        with open(manifest_path, encoding="utf-8") as file:
+            self.manifest = json.load(file)
+        if self.manifest.get("version") != staging_version:
+            raise Exception(f"Unsupported staging version {self.manifest.get('version')}")
+        self.columns: Dict[str, Optional[_VectorColumn]] = {}
+        for name in vector_fields:
+            path = os.path.join(directory, f"{name}.npy")
+            self.columns[name] = _VectorColumn(path) if self.manifest["vectors"][name]["rows"] else None
+
+    def __len__(self) -> int:
+        return self.manifest["documents"]
+
+    def __iter__(self) -> Iterator[Document]:
+        with open(os.path.join(self.directory, documents_file), encoding="utf-8") as file:
+            for line in file:
+                fields = json.loads(line)
+                for name in vector_fields:
+                    if fields[name] is not None:
+                        fields[name] = self.columns[name].row(fields[name])
+                yield Document(**fields)
+
+    def close(self):
+        for column in self.columns.values():
+            if column is not None:
+                column.close()
+
+
+if __name__ == "__main__":
+    # 示例调用
+    writer = StagingWriter(".cache/staging-example")
+    writer.append(Document(id="1", imageUrl="https://example.com/1.png", caption="example", content="",
+                           ocrContent="", captionVector=[0.1] * 4, contentVector=[0.2] * 4,
+                           ocrContentVecotor=None, imageVecotor=[0.3] * 2))
+    writer.close()
+    reader = StagingReader(".cache/staging-example")
+    for document in reader:
+        print(document.id, document.captionVector.tolist(), document.imageVecotor.tolist())
+    reader.close()
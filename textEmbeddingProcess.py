@@ -1,32 +1,101 @@
 import asyncio
 import logging
 import os
+import weakref
+from typing import List, Union
 
 from dotenv import load_dotenv
 from openai import AsyncAzureOpenAI
 
+from enrichmentCache import cached, decode_vector, encode_vector, version_of
+from microBatcher import MicroBatcher
+from rateLimiter import rate_limited
+from serviceClients import close_clients, get_client, get_httpx_client
+from textPreparation import count_tokens, truncate_to_tokens
+
 load_dotenv(verbose=True)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-azureOpenAIClient = AsyncAzureOpenAI(
-  api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
-  api_version = "2024-02-01",
-  azure_endpoint =os.getenv("AZURE_OPENAI_ENDPOINT") 
-)
+def get_embedding_client() -> AsyncAzureOpenAI:
+    return get_client("embedding", lambda: AsyncAzureOpenAI(
+        api_key = os.getenv("AZURE_OPENAI_API_KEY"),  
+        api_version = "2024-02-01",
+        # the query scripts used to read AZURE_OPENAI_BASE, older .env files may only set that
+        azure_endpoint =os.getenv("AZURE_OPENAI_ENDPOINT") or os.getenv("AZURE_OPENAI_BASE"),
+        http_client=get_httpx_client(),
+        max_retries=0  # retries and throttling are handled by rate_limited
+    ))
 
 embedding_deployment = os.getenv("EMBEDDING_MODEL_DEPLOYMENT")
+embedding_cache_version = version_of(str(embedding_deployment))
+
+# micro-batching limits for concurrent get_text_embedding_batched callers
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "16"))
+embedding_batch_max_tokens = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "32000"))
+embedding_batch_max_delay = float(os.getenv("EMBEDDING_BATCH_MAX_DELAY_MS", "50")) / 1000
+embedding_batch_max_concurrency = int(os.getenv("EMBEDDING_BATCH_MAX_CONCURRENCY", "4"))
+
+# one batcher per event loop, futures can't cross loops
+_batchers = weakref.WeakKeyDictionary()
 
 
+@cached("textVector", embedding_cache_version, encode=encode_vector, decode=decode_vector)
+@rate_limited("embedding", weigh=lambda text: count_tokens(text))
 async def get_text_embedding(text):
     logging.info(f"Getting text embedding for {text}")
     
-    response = await azureOpenAIClient.embeddings.create(input = text,model = embedding_deployment)
+    # over-long input would be rejected by the service
+    response = await get_embedding_client().embeddings.create(input = truncate_to_tokens(text),model = embedding_deployment)
     return response.data[0].embedding
 
+@rate_limited("embedding", weigh=lambda texts: sum(count_tokens(text) for text in texts))
+async def get_text_embeddings(texts: List[str]) -> List[List[float]]:
+    logging.info(f"Getting text embeddings for a batch of {len(texts)} texts")
+
+    response = await get_embedding_client().embeddings.create(input = texts,model = embedding_deployment)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+async def get_text_embeddings_each_on_rejection(texts: List[str]) -> List[Union[List[float], Exception]]:
+    """Embed ``texts`` in one call; when the service rejects the batch, embed them one by one.
+
+    A rejected input then fails only its own slot instead of every text it was batched with.
+    """
+    try:
+        return await get_text_embeddings(texts)
+    except Exception as e:
+        if getattr(e, "status_code", None) != 400 or len(texts) == 1:
+            raise
+        logging.warning(f"Embedding batch of {len(texts)} texts rejected ({e}), embedding them one by one")
+    results = await asyncio.gather(*(get_text_embeddings([text]) for text in texts), return_exceptions=True)
+    return [result if isinstance(result, BaseException) else result[0] for result in results]
+
+def get_embedding_batcher() -> MicroBatcher:
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = MicroBatcher(get_text_embeddings_each_on_rejection,
+                               max_batch_size=embedding_batch_size,
+                               max_batch_weight=embedding_batch_max_tokens,
+                               weigh=count_tokens,
+                               max_delay=embedding_batch_max_delay,
+                               max_concurrent_batches=embedding_batch_max_concurrency)
+        _batchers[loop] = batcher
+    return batcher
+
+@cached("textVector", embedding_cache_version, encode=encode_vector, decode=decode_vector)
+async def get_text_embedding_batched(text: str) -> List[float]:
+    return await get_embedding_batcher().submit(truncate_to_tokens(text))
+
+async def _main():
+    try:
+        input = "hello world!"
+        result = await get_text_embedding(input)
+        print(result)
+    finally:
+        await close_clients()
+
 if __name__ == "__main__":
     # 示例调用
-    input = "hello world!"
-    result = asyncio.run(get_text_embedding(input))
-    print(result)
\ No newline at end of file
+    asyncio.run(_main())
\ No newline at end of file
@@ -0,0 +1,98 @@
+"""Token counting, truncation and chunking of text before it is embedded."""
+import functools
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import tiktoken
+from dotenv import load_dotenv
+
+load_dotenv(verbose=True)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# text-embedding-ada-002 and text-embedding-3 use cl100k_base and accept 8191 tokens
+embedding_token_encoding = os.getenv("EMBEDDING_TOKEN_ENCODING", "cl100k_base")
+embedding_max_tokens = int(os.getenv("EMBEDDING_MAX_TOKENS", "8191"))
+# long OCR text is also embedded in overlapping chunks, indexed as child documents
+ocr_chunking_enabled = os.getenv("OCR_CHUNKING_ENABLED", "false").lower() == "true"
+ocr_chunk_tokens = int(os.getenv("OCR_CHUNK_TOKENS", "512"))
+ocr_chunk_overlap_tokens = int(os.getenv("OCR_CHUNK_OVERLAP_TOKENS", "64"))
+token_cache_size = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+
+_encoding = None
+_encoding_failed = False
+
+
+def get_encoding() -> Optional[tiktoken.Encoding]:
+    """The tokenizer, or ``None`` when its vocabulary can't be loaded (e.g. offline)."""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding(embedding_token_encoding)
+        except Exception as e:
+            # one token per character is an upper bound for both CJK and latin text
+            logging.warning(f"Could not load tokenizer {embedding_token_encoding}, counting characters instead: {e}")
+            _encoding_failed = True
+    return _encoding
+
+
+@functools.lru_cache(maxsize=token_cache_size)
+def token_offsets(text: str) -> Tuple[int, ...]:
+    """Character offset at which each token of ``text`` starts, computed once per text."""
+    encoding = get_encoding()
+    if encoding is None:
+        return tuple(range(len(text)))
+    _, offsets = encoding.decode_with_offsets(encoding.encode(text, disallowed_special=()))
+    return tuple(offsets)
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(token_offsets(text)))
+
+
+def truncate_to_tokens(text: str, max_tokens: int = embedding_max_tokens) -> str:
+    offsets = token_offsets(text)
+    if len(offsets) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    logging.info(f"Truncating text of {len(offsets)} tokens to {max_tokens}")
+    return text[:offsets[max_tokens]]
+
+
+def split_into_chunks(text: str,
+                      chunk_tokens: int = ocr_chunk_tokens,
+                      overlap_tokens: int = ocr_chunk_overlap_tokens) -> List[str]:
+    """Split ``text`` into chunks of ``chunk_tokens`` tokens, consecutive chunks sharing ``overlap_tokens``.
+
+    Chunks are cut at token boundaries of the original text, so no character
+    is split in half.
+    """
+    if overlap_tokens >= chunk_tokens:
+        raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+    offsets = token_offsets(text)
+    if len(offsets) <= chunk_tokens:
+        return [text] if text else []
+
+    chunks = []
+    step = chunk_tokens - overlap_tokens
+    for start in range(0, len(offsets), step):
+        end = start + chunk_tokens
+        chunks.append(text[offsets[start]:offsets[end] if end < len(offsets) else len(text)])
+        if end >= len(offsets):
+            break
+    return chunks
+
+
+def fit_with_suffix(text: str, suffix: str, max_tokens: int = embedding_max_tokens) -> str:
+    """Truncate ``text`` so that ``text + suffix`` fits in ``max_tokens``, keeping all of ``suffix``."""
+    return truncate_to_tokens(text, max_tokens - count_tokens(suffix)) + suffix
+
+
+if __name__ == "__main__":
+    # 示例调用
+    sample = "角色等级 Lv.55，攻击力 12000。" * 200
+    print(count_tokens(sample))
+    chunks = split_into_chunks(sample, chunk_tokens=300, overlap_tokens=30)
+    print(len(chunks), [count_tokens(chunk) for chunk in chunks])